@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Artifact repository utilities '''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+
+import requests
+
+import nimp.system
+import nimp.utils.archive
+import nimp.utils.http
+
+def get_manifest_location(archive_location):
+    ''' Returns where the manifest of an archive is published '''
+    return archive_location + '.manifest.json'
+
+def get_manifest_entries(infos, file_hashes):
+    ''' Returns the manifest entries of the given zip entries '''
+    return [ { 'name': info.filename,
+               'size': info.file_size,
+               'compressed_size': info.compress_size,
+               'crc': info.CRC,
+               'sha256': file_hashes.get(info.filename) }
+             for info in infos ]
+
+def write_manifest(archive_path, file_hashes, entries = None, archive_size = None, **archive_info):
+    ''' Publishes the manifest of an archive next to it. Besides given
+        archive info (revision, platform…) it lists every entry with its
+        size, CRC and SHA-256 hash (from file_hashes, keyed by entry name).
+        Entries and size are read from local zip archives, and have to be
+        given for other ones. '''
+    if entries is None:
+        with zipfile.ZipFile(archive_path) as archive_file:
+            entries = get_manifest_entries(archive_file.infolist(), file_hashes)
+
+    manifest = dict(archive_info)
+    manifest.update({ 'archive': archive_path.replace('\\', '/').rpartition('/')[2],
+                      'archive_size': archive_size if archive_size is not None else os.path.getsize(archive_path),
+                      'total_size': sum(entry['size'] for entry in entries),
+                      'entry_count': len(entries),
+                      'entries': entries })
+
+    _write_published_file(get_manifest_location(archive_path), json.dumps(manifest, indent = 1, sort_keys = True))
+    return manifest
+
+def load_manifest(archive_location, is_http):
+    ''' Returns the manifest of an archive, or None if it has none '''
+    manifest_content = _read_published_file(get_manifest_location(archive_location), is_http)
+    if manifest_content is None:
+        return None
+    try:
+        return json.loads(manifest_content)
+    except ValueError as ex:
+        logging.warning('Ignoring unreadable manifest of %s: %s', archive_location, ex)
+        return None
+
+def get_hash_location(archive_location):
+    ''' Returns where the SHA-256 hash of an archive is published '''
+    return archive_location + '.sha256'
+
+def write_archive_hash(archive_path, archive_hash = None):
+    ''' Publishes the SHA-256 hash of an archive next to it, in the format
+        of sha256sum. The hash is computed from local archives, and has to be
+        given for other ones. '''
+    if archive_hash is None:
+        archive_hash = compute_archive_hash(archive_path)
+
+    archive_name = archive_path.replace('\\', '/').rpartition('/')[2]
+    _write_published_file(get_hash_location(archive_path), '%s  %s\n' % (archive_hash, archive_name))
+    return archive_hash
+
+def compute_archive_hash(archive_path):
+    ''' Returns the SHA-256 hash of a local archive '''
+    with open(archive_path, 'rb') as archive_file:
+        return _compute_hash(archive_file)
+
+def load_archive_hash(archive_location, is_http):
+    ''' Returns the SHA-256 hash of an archive, or None if it has none '''
+    hash_content = _read_published_file(get_hash_location(archive_location), is_http)
+    if not hash_content or not hash_content.split():
+        return None
+    return hash_content.split()[0].lower()
+
+def matches_archive_hash(archive_file, archive_hash):
+    ''' Checks an archive has the given SHA-256 hash, reading it whole '''
+    archive_file.seek(0)
+    matches = _compute_hash(archive_file) == archive_hash
+    archive_file.seek(0)
+    return matches
+
+def _compute_hash(archive_file):
+    archive_sha256 = hashlib.sha256()
+    for chunk in iter(lambda: archive_file.read(1024 * 1024), b''):
+        archive_sha256.update(chunk)
+    return archive_sha256.hexdigest()
+
+def _write_published_file(location, content):
+    if nimp.utils.http.is_url(location):
+        nimp.utils.http.put(location, content.encode('utf8'))
+        return
+    location_tmp = location + '.tmp'
+    with open(location_tmp, 'w') as published_file:
+        published_file.write(content)
+    os.replace(location_tmp, location)
+
+def _read_published_file(location, is_http):
+    try:
+        if is_http:
+            response = nimp.utils.http.get_session().get(location, timeout = nimp.utils.http.TIMEOUT)
+            if response.status_code == 404:
+                logging.debug('No file found at %s', location)
+                return None
+            response.raise_for_status()
+            return response.text
+        location = nimp.system.sanitize_path(location)
+        if not os.path.isfile(location):
+            logging.debug('No file found at %s', location)
+            return None
+        with open(location, 'r') as published_file:
+            return published_file.read()
+    except (OSError, requests.RequestException) as ex:
+        logging.warning('Ignoring unreadable file %s: %s', location, ex)
+        return None
+
+def matches_manifest(archive_file, manifest):
+    ''' Checks an archive has the entries listed by a manifest, with the
+        same sizes and CRCs, only reading its central directory '''
+    with zipfile.ZipFile(nimp.utils.archive.FileView(archive_file)) as zip_file:
+        entries = { info.filename: (info.file_size, info.CRC) for info in zip_file.infolist() }
+    return matches_manifest_entries(entries, manifest)
+
+def matches_manifest_entries(entries, manifest):
+    ''' Checks archive entries, given as a dictionary of names to sizes and
+        CRCs, are the ones listed by a manifest '''
+    return entries == { entry['name']: (entry['size'], entry['crc']) for entry in manifest['entries'] }
+
+class CompressionPolicy(object):
+    ''' Chooses whether archive entries are stored or deflated: by extension
+        for well known file types, or else by probing the entropy of their
+        first block, since compressed data gains nothing from being deflated
+        again. Without compression, only file types listed as always deflated
+        are. Extension lists and the entropy threshold can be set in the
+        artifact_compression_policy dictionary of the configuration, with
+        'store', 'deflate' and 'max_entropy' keys. '''
+    DEFAULT_STORE_EXTENSIONS = [ '.7z', '.bik', '.bk2', '.bz2', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4',
+                                 '.ogg', '.pak', '.png', '.ucas', '.xvc', '.xvd', '.xz', '.zip', '.zst' ]
+    DEFAULT_DEFLATE_EXTENSIONS = [ '.debug', '.map', '.pdb', '.sym' ]
+    DEFAULT_MAX_ENTROPY = 7.5
+    _PROBE_SIZE = 64 * 1024
+
+    def __init__(self, compress, store_extensions = None, deflate_extensions = None, max_entropy = None):
+        self.compress = compress
+        self.store_extensions = set(extension.lower() for extension in (store_extensions if store_extensions is not None
+                                                                          else CompressionPolicy.DEFAULT_STORE_EXTENSIONS))
+        self.deflate_extensions = set(extension.lower() for extension in (deflate_extensions if deflate_extensions is not None
+                                                                            else CompressionPolicy.DEFAULT_DEFLATE_EXTENSIONS))
+        self.max_entropy = float(max_entropy) if max_entropy is not None else CompressionPolicy.DEFAULT_MAX_ENTROPY
+
+    @staticmethod
+    def from_env(env):
+        ''' Returns the compression policy set in the configuration, compressing
+            archives if asked to on the command line '''
+        policy = env.artifact_compression_policy if hasattr(env, 'artifact_compression_policy') else {}
+        return CompressionPolicy(env.compress, policy.get('store'), policy.get('deflate'), policy.get('max_entropy'))
+
+    def get_compression(self, filename):
+        ''' Returns the zip compression method a file should be archived with '''
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in self.deflate_extensions:
+            return zipfile.ZIP_DEFLATED
+        if not self.compress or extension in self.store_extensions:
+            return zipfile.ZIP_STORED
+        with open(filename, 'rb') as probed_file:
+            block = probed_file.read(CompressionPolicy._PROBE_SIZE)
+        if nimp.utils.archive.get_entropy(block) > self.max_entropy:
+            logging.debug('Storing %s, which looks compressed already', filename)
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+def log_compression_ratios(entries):
+    ''' Logs how much the entries of an archive, as listed in its manifest,
+        were compressed by file extension, largest ones first '''
+    categories = {}
+    for entry in entries:
+        extension = os.path.splitext(entry['name'])[1].lower() or '(none)'
+        file_count, file_size, compressed_size = categories.get(extension, (0, 0, 0))
+        categories[extension] = (file_count + 1, file_size + entry['size'], compressed_size + entry['compressed_size'])
+    for extension, (file_count, file_size, compressed_size) in sorted(categories.items(), key = lambda item: item[1][1], reverse = True):
+        logging.info('%s: %d files, %s compressed to %s (%.1f%%)', extension, file_count, nimp.system.format_size(file_size),
+                     nimp.system.format_size(compressed_size), 100.0 * compressed_size / file_size if file_size else 100.0)
+
+def get_delta_location(archive_location, base_revision):
+    ''' Returns where the delta of an archive against a previous revision is
+        published. Its name starts like the archive one, but revision
+        listings only match names ending with the collection pattern, so it
+        is never listed as a revision of its own. '''
+    return '%s.delta-%s.zip' % (archive_location, base_revision)
+
+def write_delta(archive_path, base_revision, base_manifest, file_hashes, archive_source = None, **archive_info):
+    ''' Publishes the delta of an archive against the manifest of a previous
+        revision: an archive of the entries added or modified since, along
+        with its hash and a manifest also listing the entries removed since.
+        The archive is read from archive_source if it is not in place yet.
+        Returns the manifest of the delta. '''
+    base_entries = { entry['name']: entry for entry in base_manifest['entries'] }
+    delta_path = get_delta_location(archive_path, base_revision)
+    delta_tmp = delta_path + '.tmp'
+    delta_hashes = {}
+    with zipfile.ZipFile(archive_source or archive_path) as archive_file, zipfile.ZipFile(delta_tmp, 'w') as delta_file:
+        for info in archive_file.infolist():
+            file_hash = file_hashes.get(info.filename)
+            if _is_unchanged(base_entries.get(info.filename), info, file_hash):
+                continue
+            delta_info = zipfile.ZipInfo(info.filename, info.date_time)
+            delta_info.compress_type = info.compress_type
+            delta_info.create_system = info.create_system
+            delta_info.external_attr = info.external_attr
+            delta_info.extra = info.extra
+            with archive_file.open(info) as entry_file, delta_file.open(delta_info, 'w') as delta_entry_file:
+                shutil.copyfileobj(entry_file, delta_entry_file, 1024 * 1024)
+            delta_hashes[info.filename] = file_hash
+        removed = sorted(set(base_entries) - set(archive_file.namelist()))
+
+    # Published last, so the delta is never found without its hash and manifest
+    write_archive_hash(delta_path, compute_archive_hash(delta_tmp))
+    delta_manifest = write_manifest(delta_path, delta_hashes, get_manifest_entries(delta_file.infolist(), delta_hashes),
+                                    os.path.getsize(delta_tmp), base_revision = str(base_revision), removed = removed, **archive_info)
+    os.replace(delta_tmp, delta_path)
+    logging.info('Delta against revision %s has %d modified and %d removed entries (%s)', base_revision,
+                 delta_manifest['entry_count'], len(removed), nimp.system.format_size(delta_manifest['archive_size']))
+    return delta_manifest
+
+def _is_unchanged(base_entry, info, file_hash):
+    if base_entry is None or (base_entry['size'], base_entry['crc']) != (info.file_size, info.CRC):
+        return False
+    # Manifests of older uploads may not have hashes
+    return file_hash is None or base_entry.get('sha256') in (None, file_hash)
+
+def get_deployed_files_path(root_dir, fileset, platform, configuration):
+    ''' Returns where the files deployed by downloads of a fileset are recorded '''
+    key = '-'.join(str(part) for part in [ fileset, platform, configuration ])
+    return os.path.join(root_dir, '.nimp', 'deployed', '%s.json' % key)
+
+class DeployedFiles(object):
+    ''' Record of the files deployed by a download, along with their
+        CRC32, so that files already up to date are not extracted again and
+        files no longer deployed can be removed. Checksums are recorded with
+        the size and modification time of files, so they are only computed
+        again for files modified since. The record also tells which revision
+        was deployed, and with which file selection. '''
+    def __init__(self, record_path):
+        self.record_path = record_path
+        self.revision = None
+        self.selection = None
+        self._known_files = {}
+        self._deployed_files = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(record_path):
+            try:
+                with open(record_path, 'r') as record_file:
+                    record = json.load(record_file)
+                self.revision = record['revision']
+                self.selection = record['selection']
+                self._known_files = record['files']
+            except (OSError, ValueError, KeyError, TypeError) as ex:
+                logging.warning('Ignoring unreadable deployment record %s: %s', record_path, ex)
+        self._recorded_files = set(self._known_files)
+
+    def is_deployed(self, revision, selection):
+        ''' Checks whether a revision was deployed with the same file
+            selection, and whether its files are still intact, i.e. have the
+            size and modification time they had once deployed '''
+        if self.revision is None or str(revision) != self.revision or selection != self.selection:
+            return False
+        for filename in self._recorded_files:
+            try:
+                file_stat = os.stat(filename)
+            except OSError:
+                return False
+            if [ file_stat.st_size, file_stat.st_mtime_ns ] != self._known_files[filename][:2]:
+                logging.debug('%s was modified since it was deployed', filename)
+                return False
+        return True
+
+    def is_up_to_date(self, filename, size, crc):
+        ''' Checks whether a file has the given size and CRC32, recording it
+            as deployed if it does '''
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return False
+        if file_stat.st_size != size:
+            return False
+
+        file_info = [ file_stat.st_size, file_stat.st_mtime_ns ]
+        with self._lock:
+            known_info = self._known_files.get(filename)
+        if known_info is None or known_info[:2] != file_info:
+            known_info = file_info + [ _compute_crc(filename) ]
+            with self._lock:
+                self._known_files[filename] = known_info
+        if known_info[2] != crc:
+            return False
+
+        with self._lock:
+            self._deployed_files[filename] = known_info
+        return True
+
+    def add(self, filename, crc):
+        ''' Records a file as deployed with the given CRC32 '''
+        file_stat = os.stat(filename)
+        with self._lock:
+            self._deployed_files[filename] = [ file_stat.st_size, file_stat.st_mtime_ns, crc ]
+            self._known_files[filename] = self._deployed_files[filename]
+
+    def discard(self, filename):
+        ''' Stops recording a file as deployed, so it is removed when pruning
+            if it was deployed before '''
+        with self._lock:
+            if self._deployed_files.pop(filename, None) is not None:
+                self._recorded_files.add(filename)
+
+    def remove_extraneous_files(self):
+        ''' Removes files recorded by the previous deployment which are not
+            part of this one '''
+        for filename in sorted(self._recorded_files - set(self._deployed_files)):
+            if os.path.isfile(filename):
+                logging.info('Removing %s', filename)
+                os.remove(filename)
+
+    def save(self, revision, selection):
+        ''' Saves the files deployed this time as the deployment record of a
+            revision, or of no revision at all if the deployed files are not
+            all known '''
+        record = { 'revision': str(revision) if revision is not None else None,
+                   'selection': selection,
+                   'files': self._deployed_files }
+        try:
+            nimp.system.safe_makedirs(os.path.dirname(self.record_path))
+            record_tmp = '%s.%d.tmp' % (self.record_path, os.getpid())
+            with open(record_tmp, 'w') as record_file:
+                json.dump(record, record_file)
+            os.replace(record_tmp, self.record_path)
+        except OSError as ex:
+            logging.warning('Unable to save deployment record %s: %s', self.record_path, ex)
+
+def _compute_crc(filename):
+    crc = 0
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xFFFFFFFF
+
+class ArchiveCache(object):
+    ''' Machine-wide cache of downloaded archives, shareable by several
+        workspaces and nimp processes. Archives are stored by key, inserted
+        atomically, and the least recently used ones are evicted once the
+        cache grows over its maximum size. '''
+    # Archives used more recently than this are never evicted, since another
+    # process may be about to open them
+    EVICTION_GRACE_PERIOD = 300
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(archive_location, archive_hash = None, validator = None):
+        ''' Returns the key of an archive: the hash of its format and
+            published SHA-256 hash if it has one, so identical archives share
+            a key whatever their location, or else the hash of its location
+            and validator. Returns None if the archive cannot be identified. '''
+        if archive_hash is not None:
+            identity = [ nimp.system.get_archive_extension(archive_location), archive_hash ]
+        elif validator is not None and (validator.get('etag') is not None or validator.get('last_modified') is not None):
+            identity = [ archive_location, validator ]
+        else:
+            return None
+        return hashlib.sha256(json.dumps(identity, sort_keys = True).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        ''' Returns the path of a cached archive, or None if not cached '''
+        if key is None:
+            return None
+        archive_path = self._get_path(key)
+        try:
+            # Marks the archive as recently used
+            os.utime(archive_path, None)
+        except OSError:
+            return None
+        return archive_path
+
+    def remove(self, key):
+        ''' Removes an archive from the cache, if cached '''
+        if key is None:
+            return
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            pass
+
+    def insert(self, key, archive_path):
+        ''' Adds a copy of an archive to the cache, then evicts the least
+            recently used archives if needed '''
+        if key is None:
+            return None
+        cached_path = self._get_path(key)
+        try:
+            nimp.system.safe_makedirs(os.path.dirname(cached_path))
+            cached_tmp = '%s.%s.tmp' % (cached_path, uuid.uuid4().hex)
+            try:
+                os.link(archive_path, cached_tmp)
+            except OSError:
+                shutil.copyfile(archive_path, cached_tmp)
+            os.replace(cached_tmp, cached_path)
+        except OSError as ex:
+            logging.warning('Unable to add %s to the archive cache: %s', archive_path, ex)
+            return None
+        self.evict(keep = cached_path)
+        return cached_path
+
+    def evict(self, keep = None):
+        ''' Removes the least recently used archives until the cache fits in
+            its maximum size '''
+        archives = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                # Archives being inserted by another process
+                if filename.endswith('.tmp'):
+                    continue
+                archive_path = os.path.join(directory, filename)
+                try:
+                    archive_stat = os.stat(archive_path)
+                except OSError:
+                    continue
+                archives.append((archive_stat.st_mtime, archive_stat.st_size, archive_path))
+
+        total_size = sum(size for _, size, _ in archives)
+        eviction_time = time.time() - ArchiveCache.EVICTION_GRACE_PERIOD
+        for access_time, size, archive_path in sorted(archives):
+            if total_size <= self.max_size or access_time > eviction_time:
+                break
+            if archive_path == keep:
+                continue
+            try:
+                # Archives opened by another process stay readable once
+                # removed on POSIX systems, but cannot be removed on Windows
+                os.remove(archive_path)
+                total_size -= size
+                logging.debug('Evicted %s from the archive cache', archive_path)
+            except OSError:
+                pass
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
@@ -21,24 +21,33 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 ''' Downloads a previously uploaded fileset to the local workspace '''
 
-import io
+import concurrent.futures
+import fnmatch
+import hashlib
 import logging
 import os
 import stat
-import tempfile
+import tarfile
+import threading
+import time
 import zipfile
+import zlib
 
 import requests
 
-#from pyremotezip import RemoteZip
-# (would be nice, but pyremotezip is python2 for now)
-
+import nimp.artifacts
 import nimp.command
 import nimp.environment
 import nimp.system
 import nimp.sys.platform
+import nimp.utils.archive
+import nimp.utils.http
 
-MAGIC = nimp.system.try_import('magic')
+# ELF, Mach-O (32 and 64 bits, both endiannesses) and scripts
+_EXECUTABLE_HEADERS = [ b'\x7fELF', b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf',
+                        b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe', b'#!' ]
+_FAT_MACHO_HEADER = b'\xca\xfe\xba\xbe'
+_CHUNK_SIZE = 1024 * 1024
 
 class DownloadFileset(nimp.command.Command):
     ''' Downloads a previously uploaded fileset to the local workspace '''
@@ -54,17 +63,52 @@ class DownloadFileset(nimp.command.Command):
         parser.add_argument('--min_revision',
                             help = 'Find a revision >= to this',
                             metavar = '<revision>')
+        parser.add_argument('--source',
+                            help = 'Artifact repository to download from, can be repeated to list mirrors, nearest first',
+                            metavar = '<location>',
+                            action = 'append',
+                            default = [])
+        parser.add_argument('--stream',
+                            help = 'Extract HTTP archives while downloading them, only checking their SHA-256 hash once extracted',
+                            action = 'store_true')
+        parser.add_argument('--connections',
+                            help = 'Number of concurrent connections used to download HTTP archives',
+                            metavar = '<count>',
+                            type = int,
+                            default = 8)
+        parser.add_argument('--retries',
+                            help = 'Number of times a failed HTTP transfer is retried',
+                            metavar = '<count>',
+                            type = int,
+                            default = 3)
+        parser.add_argument('--jobs',
+                            help = 'Number of files or nested archives extracted concurrently',
+                            metavar = '<count>',
+                            type = int,
+                            default = os.cpu_count() or 1)
+        parser.add_argument('--force',
+                            help = 'Download the fileset even if the revision is already deployed',
+                            action = 'store_true')
+        parser.add_argument('--prune',
+                            help = 'Remove files deployed by the previous download of this fileset that this one does not contain',
+                            action = 'store_true')
+        parser.add_argument('--include',
+                            help = 'Only extract files matching this pattern, can be repeated. HTTP archives are then read with range requests,'
+                                   ' which does not check them against their SHA-256 hash',
+                            metavar = '<pattern>',
+                            action = 'append',
+                            default = [])
+        parser.add_argument('--exclude',
+                            help = 'Do not extract files matching this pattern, can be repeated. HTTP archives are then read as with --include',
+                            metavar = '<pattern>',
+                            action = 'append',
+                            default = [])
         parser.add_argument('fileset', metavar = '<fileset>', help = 'fileset to download')
 
         return True
 
     def is_available(self, env):
-        if nimp.sys.platform.is_windows():
-            return True, ''
-
-        return (MAGIC is not None and hasattr(MAGIC, 'from_file'),
-                ('The python-magic module was not found on your system and is '
-                 'required by this command.'))
+        return True, ''
 
     def run(self, env):
         # Early exit, options harmonizing etc:
@@ -84,40 +128,188 @@ class DownloadFileset(nimp.command.Command):
         if env.revision is None and env.max_revision is not None and env.min_revision is not None and int(env.max_revision) == int(env.min_revision):
             env.revision = env.max_revision # speeding things up
 
-        revision_info = nimp.system.get_latest_available_revision(env, env.artifact_repository_source + '/' + env.artifact_collection[env.fileset] + '.zip', **vars(env))
+        root_dir = nimp.system.sanitize_path(env.format(env.root_dir))
+        deployed_files = nimp.artifacts.DeployedFiles(nimp.artifacts.get_deployed_files_path(root_dir, env.fileset, env.platform, env.configuration))
+        # Checked before looking for the revision when it is known, so it costs no request at all
+        if env.revision is not None and DownloadFileset._is_deployed(env, deployed_files):
+            return True
 
-        env.revision = revision_info['revision']
-        archive_location = revision_info['location']
-        if env.revision is None or archive_location is None:
+        revisions_info = DownloadFileset._find_sources(env)
+        if not revisions_info:
             logging.error("No artifact found")
             return False
+        env.revision = revisions_info[0]['revision']
+        if DownloadFileset._is_deployed(env, deployed_files):
+            return True
+
+        # Sources are listed from the nearest to the central one, whose
+        # manifest is the reference mirrors are checked against
+        manifest = None
+        for revision_info in reversed(revisions_info):
+            manifest = nimp.artifacts.load_manifest(revision_info['location'], revision_info['is_http'])
+            if manifest is not None:
+                break
 
-        logging.info("Downloading " + revision_info['location'])
+        # With a manifest, everything can be checked before transferring
+        # anything, unless it lists nested archives whose content it ignores
+        extraction_plan = None
+        if manifest is not None and not DownloadFileset._lists_nested_archives(manifest):
+            extraction_plan = DownloadFileset._plan_extraction_from_manifest(manifest, env)
+            if not DownloadFileset._check_extraction_plan(env, extraction_plan):
+                return False
 
-        # Now decompress the archive
-        archive_object = None
+        revisions_info = sorted(revisions_info, key=DownloadFileset._probe)
+        if DownloadFileset._download_deltas(revisions_info[0], manifest, deployed_files, env):
+            nimp.system.save_last_deployed_revision(env)
+            return True
+        for revision_info in revisions_info:
+            if DownloadFileset._download_from(revision_info, manifest, deployed_files, env, extraction_plan):
+                nimp.system.save_last_deployed_revision(env)
+                return True
+        return False
+
+    @staticmethod
+    def _get_selection(env):
+        return [ sorted(env.include), sorted(env.exclude) ]
+
+    @staticmethod
+    def _is_deployed(env, deployed_files):
+        if env.force or not deployed_files.is_deployed(env.revision, DownloadFileset._get_selection(env)):
+            return False
+        logging.info('Revision %s of %s is already deployed', env.revision, env.fileset)
+        nimp.system.save_last_deployed_revision(env)
+        return True
+
+    @staticmethod
+    def _get_sources(env):
+        if env.source:
+            return env.source
+        if isinstance(env.artifact_repository_source, (list, tuple)):
+            return list(env.artifact_repository_source)
+        return [ env.artifact_repository_source ]
+
+    @staticmethod
+    def _find_sources(env):
+        ''' Returns the revision info of the requested archive from every
+            source having it, in the order sources are declared '''
+        revisions_info = []
+        errors = []
+        for source in DownloadFileset._get_sources(env):
+            archive_location_format = source + '/' + env.artifact_collection[env.fileset] + '.zip'
+            try:
+                revision_info = nimp.system.get_latest_available_revision(env, archive_location_format, **vars(env))
+            except Exception as ex: #pylint: disable=broad-except
+                # Mirrors may be offline or lagging behind, others are used instead
+                logging.debug('Ignoring source %s: %s', source, ex)
+                errors.append((source, ex))
+                continue
+            if revision_info['revision'] is not None and revision_info['location'] is not None:
+                revision_info['archive_location_format'] = archive_location_format
+                revisions_info.append(revision_info)
+        if not revisions_info:
+            for source, ex in errors:
+                logging.error('%s: %s', source, ex)
+            return []
+        # Mirrors may lag behind, the latest revision found anywhere is the one deployed
+        revision = max(int(revision_info['revision']) for revision_info in revisions_info)
+        return [ revision_info for revision_info in revisions_info if int(revision_info['revision']) == revision ]
+
+    @staticmethod
+    def _probe(revision_info):
+        ''' Returns how long a source takes to answer for an archive '''
+        start_time = time.monotonic()
         try:
             if revision_info['is_http']:
-                # (pyremotezip would be nice here (snippets below), but it's python2 for now)
-                # snippets: rz = RemoteZip(archive_location); toc = rz.getTableOfContents(); output = rz.extractFile(toc[2]['filename'])
-                get_request = requests.get(archive_location, stream=True)
-                # TODO: test get_request.ok and/or get_request.status_code...
-                archive_size = int(get_request.headers['content-length'])
-                tmp_download_directory = nimp.system.sanitize_path(env.format(os.path.join(env.root_dir, env.game, 'Intermediate', 'Downloads')))
-                nimp.system.safe_makedirs(tmp_download_directory) # As NamedTemporaryFile apparently needs an existing dir when the parameter is passed
-                archive_object = tempfile.NamedTemporaryFile(prefix='tmp_', suffix='.zip', dir=tmp_download_directory)
-                logging.info('Download of %s is starting.', archive_location)
-                try:
-                    DownloadFileset._custom_copyfileobj(get_request.raw, archive_object, archive_size)
-                    logging.info('Download of %s is done!', archive_location)
-                except OSError as ex:
-                    logging.error('Download of %s has failed: %s', archive_location, ex)
-                    raise Exception('Download has failed') from ex
+                nimp.utils.http.get_session().head(revision_info['location'], timeout=10).raise_for_status()
             else:
+                os.stat(nimp.system.sanitize_path(revision_info['location']))
+        except (OSError, requests.RequestException) as ex:
+            logging.debug('Probing %s failed: %s', revision_info['location'], ex)
+            return float('inf')
+        return time.monotonic() - start_time
+
+    @staticmethod
+    def _download_from(revision_info, manifest, deployed_files, env, extraction_plan=None):
+        archive_location = revision_info['location']
+        # Tar archives have no central directory, so they are always read whole
+        is_tar_zst = archive_location.endswith('.tar.zst')
+        if is_tar_zst and nimp.system.try_import('zstandard') is None:
+            logging.error('zstandard python module is required but was not found')
+            return False
+        logging.info("Downloading " + archive_location)
+        archive_object = None
+        tmp_download_path = None
+        needs_hash_check = True
+        success = False
+        try:
+            download = None
+            archive_cache = DownloadFileset._get_archive_cache(env) if revision_info['is_http'] else None
+            if archive_cache is not None:
+                download = nimp.utils.http.Download(archive_location)
+                archive_hash = nimp.artifacts.load_archive_hash(archive_location, True)
+                cache_key = nimp.artifacts.ArchiveCache.get_key(archive_location, archive_hash, download.validator)
+                cached_path = archive_cache.get(cache_key)
+                if cached_path is not None:
+                    archive_object = open(cached_path, 'rb')
+                    if archive_hash is None or nimp.artifacts.matches_archive_hash(archive_object, archive_hash):
+                        logging.info('Using cached archive %s', cached_path)
+                        needs_hash_check = False
+                    else:
+                        # A corrupted archive would otherwise be used until evicted
+                        logging.warning('Cached archive %s does not match the SHA-256 hash of %s, downloading it again', cached_path, archive_location)
+                        archive_object.close()
+                        archive_object = None
+                        archive_cache.remove(cache_key)
+
+            if archive_object is None and revision_info['is_http'] and not is_tar_zst and (env.include or env.exclude):
+                # Only the central directory and the selected entries are transferred
+                archive_object = DownloadFileset._open_remote_archive(archive_location)
+                # Archives are only partially read then, so only the CRC of
+                # selected entries is checked
+                needs_hash_check = archive_object is None
+
+            if archive_object is None and revision_info['is_http'] and env.stream and is_tar_zst:
+                # Members are recorded as they are extracted, so the revision
+                # is deployed once the archive matched its hash
+                DownloadFileset._stream_tar_zst(archive_location, manifest, deployed_files, env)
+                DownloadFileset._save_deployment(env, deployed_files)
+                return True
+
+            if archive_object is None and revision_info['is_http'] and env.stream and DownloadFileset._stream_decompress(archive_location, manifest, env):
+                # Streamed files are not recorded, so no revision can be considered deployed
+                deployed_files.save(None, DownloadFileset._get_selection(env))
+                return True
+
+            if archive_object is None and revision_info['is_http']:
+                tmp_download_path = DownloadFileset._fetch(archive_location, env, download, extraction_plan)
+                if tmp_download_path is None:
+                    return False
+                if archive_cache is not None:
+                    archive_cache.insert(cache_key, tmp_download_path)
+                archive_object = open(tmp_download_path, 'rb')
+                # Downloads are checked against the hash as they are written
+                needs_hash_check = False
+            elif archive_object is None:
                 archive_object = open(nimp.system.sanitize_path(archive_location), 'rb')
-            DownloadFileset._decompress(archive_object, env, handle_zip_of_zips=True)
-            nimp.system.save_last_deployed_revision(env)
+            if needs_hash_check:
+                archive_hash = nimp.artifacts.load_archive_hash(archive_location, revision_info['is_http'])
+                if archive_hash is not None and not nimp.artifacts.matches_archive_hash(archive_object, archive_hash):
+                    logging.warning('%s does not match its published SHA-256 hash, ignoring it', archive_object.name)
+                    return False
 
+            if is_tar_zst:
+                DownloadFileset._extract_tar_zst(archive_object, manifest, deployed_files, env)
+            else:
+                if manifest is not None and not nimp.artifacts.matches_manifest(archive_object, manifest):
+                    logging.warning('%s does not match its manifest, ignoring it', archive_location)
+                    return False
+                if manifest is None or DownloadFileset._lists_nested_archives(manifest):
+                    extraction_plan = DownloadFileset._plan_extraction(archive_object, env, handle_zip_of_zips=True)
+                    if not DownloadFileset._check_extraction_plan(env, extraction_plan):
+                        return False
+                DownloadFileset._decompress(archive_object, env, deployed_files, handle_zip_of_zips=True)
+            DownloadFileset._save_deployment(env, deployed_files)
+            success = True
             return True
         except Exception as ex: #pylint: disable=broad-except
             logging.error('Decompression of archive %s has failed: %s', archive_location, ex)
@@ -125,57 +317,454 @@ class DownloadFileset(nimp.command.Command):
         finally:
             if archive_object is not None:
                 archive_object.close()
+            if tmp_download_path is not None and success:
+                nimp.utils.http.Download.remove(tmp_download_path)
 
     @staticmethod
-    def _decompress(file, env, handle_zip_of_zips=False):
-        zip_file = zipfile.ZipFile(file)
-        go_deeper = False
-        if handle_zip_of_zips:
-            go_deeper = True
-            for name in zip_file.namelist():
-                if not name.endswith('.zip'):
-                    go_deeper = False
-                    break
-        for name in zip_file.namelist():
-            if go_deeper:
-                DownloadFileset._decompress(io.BytesIO(zip_file.read(name)), env)
-            else:
-                logging.info('Extracting %s to %s', name, env.root_dir)
-                zip_file.extract(name, nimp.system.sanitize_path(env.format(env.root_dir)))
-                filename = nimp.system.sanitize_path(os.path.join(env.format(env.root_dir), name))
-                DownloadFileset._make_executable_if_needed(filename)
+    def _save_deployment(env, deployed_files):
+        if env.prune:
+            deployed_files.remove_extraneous_files()
+        deployed_files.save(env.revision, DownloadFileset._get_selection(env))
 
     @staticmethod
-    def _custom_copyfileobj(fsrc, fdst, source_size, length=16*1024):
-        ''' Custom version of shutil.copyfileobj tailored to add progress logging
-            for our streaming/download/http copyfileobj case '''
-        copied = 0
-        copied_perc = 0
-        download_log_perc_interval = 5
-        while 1:
-            buf = fsrc.read(length)
-            if not buf:
-                break
-            fdst.write(buf)
-            copied += len(buf)
-            new_copied_perc = int(copied * 100 / source_size)
-            if new_copied_perc >= copied_perc + download_log_perc_interval:
-                copied_perc = new_copied_perc
-                logging.info('%d%% downloaded', copied_perc)
-
-    @staticmethod
-    def _make_executable_if_needed(filename):
-        # If this is an executable or a script, make it +x
-        if MAGIC is not None:
-            filetype = MAGIC.from_file(filename)
-            if isinstance(filetype, bytes):
-                # Older versions of python-magic return bytes instead of a string
-                filetype = filetype.decode('ascii')
-
-            if 'executable' in filetype or 'script' in filetype:
+    def _extract_tar_zst(archive_file, manifest, deployed_files, env):
+        ''' Extracts a tar.zst archive in a single pass, since it has no
+            central directory to seek to anyway '''
+        zstandard = nimp.system.try_import('zstandard')
+        decompressed_reader = zstandard.ZstdDecompressor().stream_reader(archive_file)
+        with tarfile.open(fileobj=decompressed_reader, mode='r|') as tar_file:
+            DownloadFileset._extract_members(tar_file, manifest, deployed_files, env)
+
+    @staticmethod
+    def _stream_tar_zst(archive_location, manifest, deployed_files, env):
+        ''' Extracts a tar.zst archive while it is being downloaded, then
+            checks it against its hash and the reference manifest. Extracted
+            files are overwritten by the download of another source if it
+            does not match. '''
+        archive_hash = nimp.artifacts.load_archive_hash(archive_location, True)
+        logging.info('Download and extraction of %s are starting.', archive_location)
+        get_request = nimp.utils.http.get_session().get(archive_location, stream=True, timeout=nimp.utils.http.TIMEOUT)
+        try:
+            get_request.raise_for_status()
+            get_request.raw.decode_content = True
+            archive_reader = nimp.utils.archive.HashingReader(get_request.raw)
+            DownloadFileset._extract_tar_zst(archive_reader, manifest, deployed_files, env)
+            # Whatever follows the end of the tar archive is hashed too
+            while archive_reader.read(_CHUNK_SIZE):
+                pass
+        finally:
+            get_request.close()
+        if archive_hash is not None and archive_reader.sha256.hexdigest() != archive_hash:
+            raise Exception('%s does not match its published SHA-256 hash' % archive_location)
+        logging.info('Download and extraction of %s are done!', archive_location)
+
+    @staticmethod
+    def _extract_members(tar_file, manifest, deployed_files, env):
+        root_dir = nimp.system.sanitize_path(env.format(env.root_dir))
+        # Only manifests tell the CRC of members, without which they are
+        # always extracted
+        crcs = { entry['name']: entry['crc'] for entry in manifest['entries'] } if manifest is not None else {}
+        # Mirrors may publish a stale archive along with its own hash, so
+        # every member is checked against the reference manifest
+        member_entries = {}
+        extracted_count = 0
+        up_to_date_count = 0
+        for member in tar_file:
+            is_selected = DownloadFileset._is_selected(env, member.name)
+            if not is_selected and not (manifest is not None and member.isfile()):
+                continue
+            filename = nimp.utils.archive.get_target_path(root_dir, member.name)
+            if member.isdir():
+                nimp.system.safe_makedirs(filename)
+                continue
+            if not member.isfile():
+                logging.warning('Ignoring %s, which is not a regular file', member.name)
+                continue
+            if not is_selected:
+                with tar_file.extractfile(member) as member_file:
+                    member_entries[member.name] = (member.size, DownloadFileset._compute_crc(member_file))
+                continue
+            if member.name in crcs and deployed_files.is_up_to_date(filename, member.size, crcs[member.name]):
+                member_entries[member.name] = (member.size, crcs[member.name])
+                up_to_date_count += 1
+                continue
+            logging.debug('Extracting %s to %s', member.name, root_dir)
+            nimp.system.safe_makedirs(os.path.dirname(filename))
+            crc = 0
+            with tar_file.extractfile(member) as member_file, open(filename, 'wb') as output_file:
+                for chunk in iter(lambda: member_file.read(_CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    output_file.write(chunk)
+            mtime = nimp.utils.archive.get_tar_mtime(member)
+            os.utime(filename, ns=(mtime, mtime))
+            DownloadFileset._make_executable_if_needed(filename, member.mode)
+            deployed_files.add(filename, crc & 0xFFFFFFFF)
+            member_entries[member.name] = (member.size, crc & 0xFFFFFFFF)
+            extracted_count += 1
+        logging.info('Extracted %d files, %d already up to date', extracted_count, up_to_date_count)
+        if manifest is not None and not nimp.artifacts.matches_manifest_entries(member_entries, manifest):
+            raise Exception('Archive members do not match the reference manifest')
+
+    @staticmethod
+    def _compute_crc(member_file):
+        crc = 0
+        for chunk in iter(lambda: member_file.read(_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+        return crc & 0xFFFFFFFF
+
+    @staticmethod
+    def _fetch(archive_location, env, download=None, extraction_plan=None):
+        ''' Downloads an HTTP archive to the download directory, resuming the
+            previous attempt if any. Returns where the archive was downloaded,
+            or None if there is not enough space for it, along with the files
+            of the given extraction plan when they share a volume. '''
+        download = download or nimp.utils.http.Download(archive_location)
+        tmp_download_directory = nimp.system.sanitize_path(env.format(os.path.join(env.root_dir, env.game, 'Intermediate', 'Downloads')))
+        nimp.system.safe_makedirs(tmp_download_directory)
+        # A stable name, so an interrupted download is resumed by the next run
+        tmp_download_path = os.path.join(tmp_download_directory, '%s-%s.partial' % (hashlib.md5(archive_location.encode('utf8')).hexdigest()[:12],
+                                                                                   os.path.basename(archive_location)))
+        partial_size = os.path.getsize(tmp_download_path) if os.path.isfile(tmp_download_path) else 0
+        required_bytes = download.size - partial_size if download.size is not None else 0
+        # The archive is still there while files are extracted
+        if extraction_plan is not None and nimp.system.is_same_volume(tmp_download_directory, env.format(env.root_dir)):
+            required_bytes += extraction_plan.required_bytes
+        if required_bytes and not nimp.system.check_free_space(tmp_download_directory, required_bytes):
+            return None
+        logging.info('Download of %s is starting.', archive_location)
+        try:
+            archive_hash = nimp.artifacts.load_archive_hash(archive_location, True)
+            download.run(tmp_download_path, segment_count=env.connections, retries=env.retries, sha256=archive_hash)
+            logging.info('Download of %s is done!', archive_location)
+        except (OSError, nimp.utils.http.DownloadError) as ex:
+            logging.error('Download of %s has failed: %s', archive_location, ex)
+            raise Exception('Download has failed') from ex
+        return tmp_download_path
+
+    @staticmethod
+    def _download_deltas(revision_info, manifest, deployed_files, env):
+        ''' Brings the deployed revision up to date by applying the deltas
+            published since, if they are smaller than the archive. Returns
+            False if the archive has to be downloaded instead. '''
+        selection = DownloadFileset._get_selection(env)
+        if env.force or manifest is None or deployed_files.revision is None or int(deployed_files.revision) >= int(env.revision):
+            return False
+        # Deltas only apply to the files of the deployed revision
+        if not deployed_files.is_deployed(deployed_files.revision, selection):
+            return False
+        deltas = DownloadFileset._find_deltas(revision_info, manifest, deployed_files.revision, env)
+        if deltas is None:
+            return False
+
+        root_dir = nimp.system.sanitize_path(env.format(env.root_dir))
+        for delta_location, delta_manifest in deltas:
+            logging.info('Applying delta %s', delta_location)
+            delta_object = None
+            tmp_download_path = None
+            try:
+                if revision_info['is_http']:
+                    tmp_download_path = DownloadFileset._fetch(delta_location, env)
+                    if tmp_download_path is None:
+                        return False
+                    delta_object = open(tmp_download_path, 'rb')
+                else:
+                    delta_object = open(nimp.system.sanitize_path(delta_location), 'rb')
+                if not nimp.artifacts.matches_manifest(delta_object, delta_manifest):
+                    logging.warning('%s does not match its manifest, downloading the whole archive', delta_location)
+                    return False
+                DownloadFileset._decompress(delta_object, env, deployed_files)
+            except Exception as ex: #pylint: disable=broad-except
+                logging.warning('Applying delta %s has failed (%s), downloading the whole archive', delta_location, ex)
+                return False
+            finally:
+                if delta_object is not None:
+                    delta_object.close()
+                if tmp_download_path is not None:
+                    nimp.utils.http.Download.remove(tmp_download_path)
+            for name in delta_manifest['removed']:
+                deployed_files.discard(nimp.utils.archive.get_target_path(root_dir, name))
+
+        # Files no delta touched are checked against their recorded checksums
+        for entry in manifest['entries']:
+            if not DownloadFileset._is_selected(env, entry['name']):
+                continue
+            if not deployed_files.is_up_to_date(nimp.utils.archive.get_target_path(root_dir, entry['name']), entry['size'], entry['crc']):
+                logging.warning('%s does not match revision %s once deltas are applied, downloading the whole archive', entry['name'], env.revision)
+                return False
+        if env.prune:
+            deployed_files.remove_extraneous_files()
+        deployed_files.save(env.revision, selection)
+        return True
+
+    @staticmethod
+    def _find_deltas(revision_info, manifest, deployed_revision, env):
+        ''' Returns the deltas leading from the deployed revision to the
+            requested one, oldest first, along with their manifests. Returns
+            None if there is no such chain, or if it is not smaller than the
+            archive itself. '''
+        revisions = None
+        archive_location = revision_info['location']
+        archive_size = manifest['archive_size']
+        deltas = []
+        delta_size = 0
+        while manifest is not None and manifest.get('delta_base') is not None and int(manifest['delta_base']) >= int(deployed_revision):
+            base_revision = manifest['delta_base']
+            delta_location = nimp.artifacts.get_delta_location(archive_location, base_revision)
+            delta_manifest = nimp.artifacts.load_manifest(delta_location, revision_info['is_http'])
+            if delta_manifest is None:
+                return None
+            delta_size += delta_manifest['archive_size']
+            if delta_size >= archive_size:
+                logging.debug('Deltas from revision %s are larger than the archive', base_revision)
+                return None
+            deltas.insert(0, (delta_location, delta_manifest))
+            if int(base_revision) == int(deployed_revision):
+                logging.info('Revision %s can be deployed from revision %s with %d deltas (%s)', env.revision, deployed_revision,
+                             len(deltas), nimp.system.format_size(delta_size))
+                return deltas
+
+            # Intermediate revisions are only read for their manifest
+            if revisions is None:
+                revisions = {}
+                for listed_info in nimp.system.list_all_revisions(env, revision_info['archive_location_format'], revision = '*'):
+                    revisions.setdefault(int(listed_info['revision']), listed_info)
+            base_info = revisions.get(int(base_revision))
+            if base_info is None:
+                return None
+            archive_location = base_info['location']
+            manifest = nimp.artifacts.load_manifest(archive_location, revision_info['is_http'])
+        return None
+
+    @staticmethod
+    def _get_archive_cache(env):
+        if not hasattr(env, 'artifact_cache_directory') or not env.artifact_cache_directory:
+            return None
+        max_size = int(env.artifact_cache_max_size) if hasattr(env, 'artifact_cache_max_size') else 20 * 1024 ** 3
+        return nimp.artifacts.ArchiveCache(nimp.system.sanitize_path(env.format(env.artifact_cache_directory)), max_size)
+
+    @staticmethod
+    def _is_selected(env, name):
+        if env.include and not any(fnmatch.fnmatch(name, pattern) for pattern in env.include):
+            return False
+        return not any(fnmatch.fnmatch(name, pattern) for pattern in env.exclude)
+
+    @staticmethod
+    def _open_remote_archive(archive_location):
+        ''' Opens an HTTP archive for reading with range requests, returns
+            None if the server does not support them '''
+        try:
+            return nimp.utils.http.RangeFile(archive_location)
+        except (nimp.utils.http.RangeNotSupportedError, requests.RequestException) as ex:
+            logging.warning('Cannot read %s remotely (%s), downloading the whole archive', archive_location, ex)
+            return None
+
+    @staticmethod
+    def _is_zip_of_zips(zip_file):
+        return all(name.endswith('.zip') for name in zip_file.namelist())
+
+    @staticmethod
+    def _lists_nested_archives(manifest):
+        return all(entry['name'].endswith('.zip') for entry in manifest['entries'])
+
+    @staticmethod
+    def _check_extraction_plan(env, extraction_plan):
+        logging.info('Extraction plan: %s', extraction_plan)
+        return nimp.system.check_free_space(env.format(env.root_dir), extraction_plan.required_bytes)
+
+    @staticmethod
+    def _plan_extraction_from_manifest(manifest, env):
+        plan = nimp.system.CopyPlan()
+        for entry in manifest['entries']:
+            if not DownloadFileset._is_selected(env, entry['name']):
+                continue
+            filename = nimp.system.sanitize_path(os.path.join(env.format(env.root_dir), entry['name']))
+            replaced_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+            plan.add(entry['size'], replaced_size=replaced_size)
+        return plan
+
+    @staticmethod
+    def _plan_extraction(file, env, handle_zip_of_zips=False, plan=None):
+        ''' Sums up the extraction cost from the central directory, without
+            inflating anything '''
+        plan = plan if plan is not None else nimp.system.CopyPlan()
+        zip_file = zipfile.ZipFile(nimp.utils.archive.FileView(file))
+        go_deeper = handle_zip_of_zips and DownloadFileset._is_zip_of_zips(zip_file)
+        for info in zip_file.infolist():
+            if go_deeper:
                 try:
-                    logging.info('Making executable because of file type: %s', filetype)
-                    file_stat = os.stat(filename)
-                    os.chmod(filename, file_stat.st_mode | stat.S_IEXEC)
-                except Exception: #pylint: disable=broad-except
+                    # Stored members are read in place, so only the inner central directory is read
+                    with nimp.utils.archive.open_member(zip_file, info) as inner_file:
+                        DownloadFileset._plan_extraction(inner_file, env, plan=plan)
+                    continue
+                except zipfile.BadZipFile:
                     pass
+            if not DownloadFileset._is_selected(env, info.filename):
+                continue
+            filename = nimp.system.sanitize_path(os.path.join(env.format(env.root_dir), info.filename))
+            replaced_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+            plan.add(info.file_size, replaced_size=replaced_size)
+        file.seek(0)
+        return plan
+
+    @staticmethod
+    def _decompress(file, env, deployed_files, handle_zip_of_zips=False, worker_count=None):
+        worker_count = worker_count if worker_count is not None else env.jobs
+        archive_view = nimp.utils.archive.FileView(file)
+        zip_file = zipfile.ZipFile(archive_view)
+        if handle_zip_of_zips and DownloadFileset._is_zip_of_zips(zip_file):
+            # Nested archives are read in place instead of being loaded in
+            # memory, each one from its own view of the outer archive
+            infos = zip_file.infolist()
+            inner_worker_count = max(1, worker_count // max(1, len(infos)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+                results = [ executor.submit(DownloadFileset._decompress_member, archive_view, info, env, deployed_files, inner_worker_count) for info in infos ]
+                for result in results:
+                    result.result()
+            return
+
+        root_dir = nimp.system.sanitize_path(env.format(env.root_dir))
+        infos = [ info for info in zip_file.infolist() if DownloadFileset._is_selected(env, info.filename) ]
+        # Directories are created beforehand, so workers do not race creating them
+        directories = { nimp.utils.archive.get_target_path(root_dir, info.filename) if info.is_dir()
+                        else os.path.dirname(nimp.utils.archive.get_target_path(root_dir, info.filename)) for info in infos }
+        for directory in sorted(directories):
+            nimp.system.safe_makedirs(directory)
+
+        # Largest entries first, spread over workers so they get similar amounts of data
+        batches = [ [] for _ in range(max(1, min(worker_count, len(infos)))) ]
+        for index, info in enumerate(sorted(infos, key=lambda info: info.file_size, reverse=True)):
+            batches[index % len(batches)].append(info)
+
+        progress = _ExtractionProgress(infos)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = [ executor.submit(DownloadFileset._extract_entries, archive_view, batch, root_dir, deployed_files, progress) for batch in batches ]
+            for result in results:
+                result.result()
+        progress.done()
+
+    @staticmethod
+    def _extract_entries(archive_view, infos, root_dir, deployed_files, progress):
+        with zipfile.ZipFile(nimp.utils.archive.FileView(archive_view)) as zip_file:
+            for info in infos:
+                if info.is_dir():
+                    progress.add(info)
+                    continue
+                filename = nimp.utils.archive.get_target_path(root_dir, info.filename)
+                # Rewriting identical files would only trigger rebuilds downstream
+                if deployed_files.is_up_to_date(filename, info.file_size, info.CRC):
+                    progress.add(info, extracted=False)
+                    continue
+                logging.debug('Extracting %s to %s', info.filename, root_dir)
+                zip_file.extract(info, root_dir)
+                # Extracted files would otherwise look newer than anything built from them
+                nimp.utils.archive.restore_mtime(filename, info.date_time, info.extra)
+                DownloadFileset._make_executable_if_needed(filename, DownloadFileset._get_mode(info))
+                deployed_files.add(filename, info.CRC)
+                progress.add(info)
+
+    @staticmethod
+    def _decompress_member(archive_view, info, env, deployed_files, worker_count):
+        with zipfile.ZipFile(nimp.utils.archive.FileView(archive_view)) as zip_file:
+            with nimp.utils.archive.open_member(zip_file, info) as member_file:
+                DownloadFileset._decompress(member_file, env, deployed_files, worker_count=worker_count)
+
+    @staticmethod
+    def _stream_decompress(archive_location, manifest, env):
+        ''' Extracts an archive while it is being downloaded, then checks it
+            against its hash and the reference manifest. Returns False if the
+            archive cannot be streamed and has to be downloaded first. '''
+        archive_hash = nimp.artifacts.load_archive_hash(archive_location, True)
+        logging.info('Download and extraction of %s are starting.', archive_location)
+        get_request = nimp.utils.http.get_session().get(archive_location, stream=True, timeout=nimp.utils.http.TIMEOUT)
+        try:
+            get_request.raise_for_status()
+            get_request.raw.decode_content = True
+            archive_reader = nimp.utils.archive.HashingReader(get_request.raw)
+            root_dir = nimp.system.sanitize_path(env.format(env.root_dir))
+            entry_filter = lambda name: DownloadFileset._is_selected(env, name)
+            extracted_count = 0
+            read_entries = {}
+            for filename in nimp.utils.archive.stream_extract(archive_reader, root_dir, handle_zip_of_zips=True,
+                                                              entry_filter=entry_filter, read_entries=read_entries):
+                logging.debug('Extracted %s', filename)
+                DownloadFileset._make_executable_if_needed(filename)
+                extracted_count += 1
+            # The central directory is hashed too
+            while archive_reader.read(_CHUNK_SIZE):
+                pass
+        except nimp.utils.archive.StreamingNotSupportedError as ex:
+            logging.warning('Cannot extract %s while downloading it (%s), downloading it first', archive_location, ex)
+            return False
+        finally:
+            get_request.close()
+        # Extracted files are not recorded as deployed, so they are
+        # overwritten by the download of another source
+        if archive_hash is not None and archive_reader.sha256.hexdigest() != archive_hash:
+            raise Exception('%s does not match its published SHA-256 hash' % archive_location)
+        if manifest is not None and not nimp.artifacts.matches_manifest_entries(read_entries, manifest):
+            raise Exception('%s does not match the reference manifest' % archive_location)
+        logging.info('Extracted %d files', extracted_count)
+        logging.info('Download and extraction of %s are done!', archive_location)
+        return True
+
+    @staticmethod
+    def _get_mode(info):
+        # Archives created on Unix keep file modes in the high bits of external_attr
+        return (info.external_attr >> 16) & 0o777 if info.create_system == 3 else 0
+
+    @staticmethod
+    def _make_executable_if_needed(filename, mode=0):
+        if nimp.sys.platform.is_windows():
+            return
+        try:
+            # Only exec bits are restored, files archived read-only from
+            # Perforce would otherwise not be writable by the next extraction
+            if mode & 0o111:
+                os.chmod(filename, os.stat(filename).st_mode | (mode & 0o111))
+            elif DownloadFileset._has_executable_header(filename):
+                logging.debug('Making %s executable because of its header', filename)
+                os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+        except OSError as ex:
+            logging.warning('Unable to make %s executable: %s', filename, ex)
+
+    @staticmethod
+    def _has_executable_header(filename):
+        with open(filename, 'rb') as file_to_check:
+            header = file_to_check.read(8)
+        if any(header.startswith(executable_header) for executable_header in _EXECUTABLE_HEADERS):
+            return True
+        # Universal binaries share their magic number with Java classes, which
+        # have a much higher version where universal binaries have an
+        # architecture count
+        return header.startswith(_FAT_MACHO_HEADER) and len(header) == 8 and int.from_bytes(header[4:], 'big') < 64
+
+class _ExtractionProgress(object):
+    ''' Logs how far an extraction went at regular intervals, instead of
+        logging every entry '''
+    def __init__(self, infos):
+        self.file_count = len(infos)
+        self.total_size = sum(info.file_size for info in infos)
+        self._extracted_count = 0
+        self._extracted_size = 0
+        self._up_to_date_count = 0
+        self._start_time = time.monotonic()
+        self._log_time = self._start_time
+        self._lock = threading.Lock()
+
+    def add(self, info, extracted=True):
+        ''' Counts an entry as extracted, or as already up to date '''
+        with self._lock:
+            if extracted:
+                self._extracted_count += 1
+                self._extracted_size += info.file_size
+            else:
+                self._up_to_date_count += 1
+            if time.monotonic() - self._log_time >= 5:
+                self._log_time = time.monotonic()
+                logging.info('Processed %d/%d files, %d extracted (%s)', self._extracted_count + self._up_to_date_count, self.file_count,
+                             self._extracted_count, nimp.system.format_size(self._extracted_size))
+
+    def done(self):
+        ''' Logs a summary of the whole extraction '''
+        logging.info('Extracted %d files (%s), %d already up to date, in %.1fs', self._extracted_count,
+                     nimp.system.format_size(self._extracted_size), self._up_to_date_count, time.monotonic() - self._start_time)
@@ -213,19 +213,25 @@ class Package(nimp.command.Command):
         source = nimp.system.sanitize_path(source)
         destination = nimp.system.sanitize_path(destination)
 
-        if os.path.exists(destination):
-            logging.info('Removing %s', destination)
-            shutil.rmtree(destination, ignore_errors = True)
-        os.makedirs(destination)
-
         if platform in [ 'Linux', 'Mac', 'Win32', 'Win64' ]:
+            # Mirroring only copies what changed since the previous package
             package_fileset = nimp.system.map_files(env)
             package_fileset.src(source[ len(env.root_dir) + 1 : ]).to(destination).glob('**')
-            package_success = nimp.system.all_map(nimp.system.robocopy, package_fileset())
+            package_plan = nimp.system.plan_copy(package_fileset(), skip_up_to_date = True, in_place = False)
+            logging.info('Package plan: %s', package_plan)
+            if not nimp.system.check_free_space(destination, package_plan.required_bytes):
+                raise RuntimeError('Package failed')
+            package_success = nimp.system.mirror(package_fileset(), destination)
             if not package_success:
                 raise RuntimeError('Package failed')
+            return
 
-        elif platform == 'XboxOne':
+        if os.path.exists(destination):
+            logging.info('Removing %s', destination)
+            shutil.rmtree(destination, ignore_errors = True)
+        os.makedirs(destination)
+
+        if platform == 'XboxOne':
             package_tool_path = nimp.system.sanitize_path(os.environ['DurangoXDK'] + '/bin/MakePkg.exe')
             game_os = nimp.system.sanitize_path(source + '/era.xvd')
             ini_file_path = nimp.system.sanitize_path(project_directory + '/Config/XboxOne/XboxOneEngine.ini')
@@ -24,9 +24,16 @@
 import logging
 import os
 import shutil
+import tarfile
 import zipfile
 
+import requests
+
+import nimp.artifacts
 import nimp.command
+import nimp.system
+import nimp.utils.archive
+import nimp.utils.http
 
 
 class UploadFileset(nimp.command.Command):
@@ -38,8 +45,11 @@ class UploadFileset(nimp.command.Command):
         nimp.command.add_common_arguments(parser, 'platform', 'revision', 'free_parameters')
         parser.add_argument('fileset', metavar = '<fileset>', help = 'fileset to upload')
         parser.add_argument('-c', '--configuration_list', metavar = '<target/configuration>', nargs = '+', help = 'target and configuration pairs to upload')
-        parser.add_argument('--archive', default = False, action = 'store_true', help = 'upload the files as a zip archive')
-        parser.add_argument('--compress', default = False, action = 'store_true', help = 'if uploading as an archive, compress it')
+        parser.add_argument('--archive', default = False, action = 'store_true', help = 'upload the files as an archive')
+        parser.add_argument('--compress', default = False, action = 'store_true', help = 'if uploading as a zip archive, compress files not already compressed')
+        parser.add_argument('--archive_format', default = 'zip', choices = [ 'zip', 'tar.zst' ], help = 'if uploading as an archive, its format, tar.zst ones being always compressed')
+        parser.add_argument('--jobs', metavar = '<count>', type = int, default = os.cpu_count() or 1, help = 'if compressing an archive, number of threads compressing it')
+        parser.add_argument('--delta', default = False, action = 'store_true', help = 'if uploading as an archive, also publish its delta against the previous revision')
         parser.add_argument('--torrent', default = False, action = 'store_true', help = 'create a torrent for the uploaded fileset')
         return True
 
@@ -50,6 +60,14 @@ class UploadFileset(nimp.command.Command):
         if env.torrent and nimp.system.try_import('BitTornado') is None:
             logging.error('bittornado python module is required but was not found')
             return False
+        if env.archive and env.archive_format == 'tar.zst' and nimp.system.try_import('zstandard') is None:
+            logging.error('zstandard python module is required but was not found')
+            return False
+
+        is_http = nimp.utils.http.is_url(env.artifact_repository_destination)
+        if is_http and (not env.archive or env.torrent):
+            logging.error('Filesets can only be uploaded to HTTP servers as archives, without torrents')
+            return False
 
         if len(env.configuration_list) == 1:
             env.target, env.configuration = env.configuration_list[0].split('/')
@@ -65,9 +83,17 @@ class UploadFileset(nimp.command.Command):
             files_override = files_to_deploy.override(configuration = configuration, target = target)
             files_override.to('.' if env.archive else output_path).load_set(env.fileset)
 
+        # A stored archive is about as large as its content, so the same plan
+        # covers both upload modes
+        upload_plan = nimp.system.plan_copy(files_to_deploy(), in_place = not env.archive)
+        logging.info('Upload plan: %s', upload_plan)
+        if not is_http and not nimp.system.check_free_space(env.format(env.artifact_repository_destination), upload_plan.required_bytes):
+            return False
+
         if env.archive:
-            compression = zipfile.ZIP_DEFLATED if env.compress else zipfile.ZIP_STORED
-            success, archive_path = UploadFileset._create_archive(env, output_path, files_to_deploy(), compression)
+            success, archive_path = UploadFileset._create_archive(env, output_path, files_to_deploy())
+            if success and not is_http:
+                nimp.system.update_revision_index(env, output_path + '.' + env.archive_format)
             if success and env.torrent:
                 torrent_files = nimp.system.map_files(env)
                 torrent_files.src(archive_path).to(os.path.basename(archive_path))
@@ -81,31 +107,147 @@ class UploadFileset(nimp.command.Command):
         return success
 
     @staticmethod
-    def _create_archive(env, archive_path, file_collection, compression):
-        archive_path = nimp.system.sanitize_path(env.format(archive_path))
-        if not archive_path.endswith('.zip'):
-            archive_path += '.zip'
+    def _create_archive(env, archive_location_format, file_collection):
+        is_http = nimp.utils.http.is_url(archive_location_format)
+        archive_path = env.format(archive_location_format)
+        if not is_http:
+            archive_path = nimp.system.sanitize_path(archive_path)
+        if not archive_path.endswith('.' + env.archive_format):
+            archive_path += '.' + env.archive_format
+
+        file_collection = [ (src, dst) for src, dst in file_collection if os.path.isfile(src) ]
+        if not file_collection:
+            logging.error("Archive is empty")
+            return False, None
+
+        logging.info('Creating %s archive %s…', env.archive_format, archive_path)
+        try:
+            UploadFileset._publish_archive(env, archive_location_format, archive_path, file_collection)
+        except (nimp.utils.http.UploadError, requests.RequestException) as ex:
+            logging.error('Publishing %s archive has failed: %s', env.archive_format, ex)
+            return False, None
+        return True, archive_path
+
+    @staticmethod
+    def _publish_archive(env, archive_location_format, archive_path, file_collection):
+        ''' Writes an archive with its manifest and hash, and its delta if
+            asked to, to a filesystem or to an HTTP server. The archive is
+            moved into place last, so it is never found without them. '''
+        is_http = nimp.utils.http.is_url(archive_path)
         archive_tmp = archive_path + '.tmp'
+        if is_http:
+            # Sent while it is written, so it never has to fit on disk
+            nimp.utils.http.make_collections(archive_path)
+            archive_output = nimp.utils.http.UploadStream(archive_tmp)
+        else:
+            if not os.path.isdir(os.path.dirname(archive_path)):
+                nimp.system.safe_makedirs(os.path.dirname(archive_path))
+            archive_output = open(archive_tmp, 'wb')
+
+        try:
+            with archive_output:
+                if env.archive_format == 'tar.zst':
+                    file_hashes, entries = UploadFileset._write_tar_zst(env, archive_output, file_collection)
+                else:
+                    compression_policy = nimp.artifacts.CompressionPolicy.from_env(env)
+                    file_hashes, entries = UploadFileset._write_zip(env, archive_output, file_collection, compression_policy)
+
+            if is_http:
+                archive_size, archive_hash = archive_output.size, archive_output.sha256.hexdigest()
+            else:
+                archive_size, archive_hash = os.path.getsize(archive_tmp), nimp.artifacts.compute_archive_hash(archive_tmp)
+            if env.archive_format == 'zip':
+                nimp.artifacts.log_compression_ratios(entries)
 
-        logging.info('Creating zip archive %s…', archive_path)
+            archive_info = { 'fileset': env.fileset, 'revision': env.revision, 'platform': env.platform,
+                             'configuration': getattr(env, 'configuration', None), 'configuration_list': env.configuration_list }
+            if env.delta and (env.archive_format != 'zip' or is_http):
+                logging.warning('Deltas can only be published for zip archives uploaded to a filesystem')
+            elif env.delta:
+                base_revision, base_manifest = UploadFileset._load_base_manifest(env, archive_location_format)
+                if base_manifest is not None:
+                    nimp.artifacts.write_delta(archive_path, base_revision, base_manifest, file_hashes,
+                                               archive_source = archive_tmp, **archive_info)
+                    # Downloads follow these links from revision to revision
+                    archive_info['delta_base'] = base_revision
 
-        if not os.path.isdir(os.path.dirname(archive_path)):
-            nimp.system.safe_makedirs(os.path.dirname(archive_path))
+            nimp.artifacts.write_archive_hash(archive_path, archive_hash)
+            nimp.artifacts.write_manifest(archive_path, file_hashes, entries, archive_size, **archive_info)
 
-        is_empty = True
-        with zipfile.ZipFile(archive_tmp, 'w', compression = compression) as archive_file:
-            for src, dst in file_collection:
-                if os.path.isfile(src):
+            if is_http:
+                nimp.utils.http.move(archive_tmp, archive_path)
+            else:
+                shutil.move(archive_tmp, archive_path)
+        except Exception:
+            # Archives failing to publish are not left behind
+            if is_http:
+                nimp.utils.http.delete(archive_tmp)
+            elif os.path.isfile(archive_tmp):
+                os.remove(archive_tmp)
+            raise
+
+    @staticmethod
+    def _write_zip(env, archive_output, file_collection, compression_policy):
+        file_hashes = {}
+        with zipfile.ZipFile(archive_output, 'w') as archive_file:
+            with nimp.utils.archive.ParallelZipWriter(archive_file, env.jobs) as archive_writer:
+                for src, dst in file_collection:
                     logging.debug('Adding %s as %s', src, dst)
-                    archive_file.write(src, dst)
-                    is_empty = False
+                    entry_info = zipfile.ZipInfo.from_file(src, dst)
+                    entry_info.compress_type = compression_policy.get_compression(src)
+                    entry_info.extra = nimp.utils.archive.get_timestamp_extra(os.stat(src).st_mtime_ns)
+                    # Files are hashed while being archived, so they are read only once
+                    file_hashes[entry_info.filename] = archive_writer.add(src, entry_info)
+        return file_hashes, nimp.artifacts.get_manifest_entries(archive_file.infolist(), file_hashes)
 
-        if is_empty:
-            logging.error("Archive is empty")
-            os.remove(archive_tmp)
-            return False, None
-        shutil.move(archive_tmp, archive_path)
-        return True, archive_path
+    @staticmethod
+    def _write_tar_zst(env, archive_output, file_collection):
+        ''' Writes files to a tar archive compressed with zstd on several
+            threads while it is written. Files are hashed along the way, and
+            since tar archives have no central directory, manifest entries are
+            returned along with their hashes. '''
+        zstandard = nimp.system.try_import('zstandard')
+        compressor = zstandard.ZstdCompressor(threads = env.jobs)
+        file_hashes = {}
+        entries = []
+        with compressor.stream_writer(archive_output, closefd = False) as compressed_file:
+            with tarfile.open(fileobj = compressed_file, mode = 'w|', format = tarfile.PAX_FORMAT) as tar_file:
+                for src, dst in file_collection:
+                    logging.debug('Adding %s as %s', src, dst)
+                    # Same names as zip entries
+                    member_info = tar_file.gettarinfo(src, os.path.normpath(os.path.splitdrive(dst)[1]))
+                    member_info.uid = member_info.gid = 0
+                    member_info.uname = member_info.gname = ''
+                    nimp.utils.archive.set_tar_mtime(member_info, os.stat(src).st_mtime_ns)
+                    with open(src, 'rb') as src_file:
+                        reader = nimp.utils.archive.HashingReader(src_file)
+                        tar_file.addfile(member_info, reader)
+                    file_hashes[member_info.name] = reader.sha256.hexdigest()
+                    entries.append({ 'name': member_info.name,
+                                     'size': reader.size,
+                                     'compressed_size': None,
+                                     'crc': reader.crc,
+                                     'sha256': file_hashes[member_info.name] })
+        return file_hashes, entries
+
+    @staticmethod
+    def _load_base_manifest(env, archive_location_format):
+        ''' Returns the previous revision of an archive with its manifest, or
+            None if there is none '''
+        if env.revision is None:
+            return None, None
+        if not archive_location_format.endswith('.zip'):
+            archive_location_format += '.zip'
+        revisions_info = nimp.system.list_all_revisions(env, archive_location_format, revision = '*')
+        base_info = nimp.system.find_latest_revision(revisions_info, max_revision = int(env.revision) - 1)
+        if base_info is None:
+            logging.info('No previous revision found, not publishing a delta')
+            return None, None
+        base_manifest = nimp.artifacts.load_manifest(base_info['location'], base_info['is_http'])
+        if base_manifest is None:
+            logging.info('Revision %s has no manifest, not publishing a delta', base_info['revision'])
+            return None, None
+        return base_info['revision'], base_manifest
 
     @staticmethod
     def _create_torrent(env, torrent_path, file_collection):
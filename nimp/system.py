@@ -24,21 +24,24 @@
 import datetime
 import fnmatch
 import glob
+import hashlib
+import json
 import logging
 import os
 import os.path
 import re
 import shutil
 import stat
+import string
 import time
 import importlib
 
 import glob2
-import requests
 
 import nimp.environment
 import nimp.sys.platform
 import nimp.sys.process
+import nimp.utils.http
 
 def try_import(module_name):
     ''' Tries to import a module, return none if unavailable '''
@@ -159,6 +162,157 @@ def safe_delete(path):
             pass
 
 
+def mirror(fileset, destination):
+    ''' Makes destination an exact copy of the given fileset.
+
+        Files are staged in a shadow directory seeded with hard links to the
+        files of the current tree that are up to date, so only changed files
+        are actually copied. Entries that are not part of the fileset are
+        dropped, then the shadow directory is swapped with the destination
+        with two renames: other processes never see a half updated tree,
+        though the destination briefly does not exist between the renames. '''
+    destination = os.path.normpath(sanitize_path(destination))
+    shadow = destination + '.mirror'
+    if os.path.exists(shadow):
+        shutil.rmtree(shadow, ignore_errors = True)
+    safe_makedirs(shadow)
+
+    linked_count = 0
+    copied_count = 0
+    for src, dest in fileset:
+        src = sanitize_path(src)
+        relative_dest = os.path.relpath(os.path.normpath(sanitize_path(dest)), destination)
+        if relative_dest.split(os.sep)[0] == os.pardir:
+            logging.error('Error: “%s” is not inside mirrored directory “%s”', dest, destination)
+            shutil.rmtree(shadow, ignore_errors = True)
+            return False
+
+        shadow_dest = os.path.join(shadow, relative_dest)
+        if os.path.isdir(src):
+            safe_makedirs(shadow_dest)
+            continue
+
+        # Never write through a hard link, it would alter the live tree
+        if os.path.lexists(shadow_dest):
+            os.remove(shadow_dest)
+
+        current_dest = os.path.join(destination, relative_dest)
+        if _is_up_to_date(src, current_dest) and _try_link(current_dest, shadow_dest):
+            linked_count += 1
+            continue
+
+        if not robocopy(src, shadow_dest):
+            shutil.rmtree(shadow, ignore_errors = True)
+            return False
+        copied_count += 1
+
+    logging.info('Mirroring to “%s”: %d files copied, %d files unchanged',
+                 destination, copied_count, linked_count)
+    _swap_directories(shadow, destination)
+    return True
+
+def _is_up_to_date(src, dest):
+    if not os.path.isfile(src) or not os.path.isfile(dest):
+        return False
+    src_stat = os.stat(src)
+    dest_stat = os.stat(dest)
+    # Copies keep the modification time of their source, so any difference,
+    # older or newer, means the destination holds other content
+    return src_stat.st_size == dest_stat.st_size and abs(src_stat.st_mtime - dest_stat.st_mtime) < 1
+
+def _try_link(src, dest):
+    safe_makedirs(os.path.dirname(dest))
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as ex:
+        # Cross device, or file system without hard link support
+        logging.debug('Cannot link “%s” to “%s”: %s', src, dest, ex)
+        return False
+
+def _swap_directories(new, current):
+    # Not atomic: the destination is missing between the two renames, but
+    # never half updated. The old tree is only deleted once the new one is
+    # live.
+    old = current + '.old'
+    if os.path.exists(old):
+        shutil.rmtree(old, ignore_errors = True)
+    if os.path.exists(current):
+        os.rename(current, old)
+    os.rename(new, current)
+    shutil.rmtree(old, ignore_errors = True)
+
+class CopyPlan(object):
+    ''' Summary of the work needed to copy a set of files '''
+    def __init__(self):
+        self.file_count = 0
+        self.total_bytes = 0
+        self.skipped_bytes = 0
+        self.required_bytes = 0
+
+    def add(self, size, up_to_date = False, replaced_size = 0):
+        ''' Adds a file to the plan. replaced_size is the size of the file
+            being overwritten, whose space is reclaimed by the copy '''
+        self.file_count += 1
+        self.total_bytes += size
+        if up_to_date:
+            self.skipped_bytes += size
+        else:
+            self.required_bytes += max(0, size - replaced_size)
+
+    def __str__(self):
+        return '%d files, %s total, %s up to date, %s of free space required' % (
+            self.file_count, format_size(self.total_bytes),
+            format_size(self.skipped_bytes), format_size(self.required_bytes))
+
+def plan_copy(fileset, skip_up_to_date = False, in_place = True):
+    ''' Computes what copying a fileset will cost, in a single stat pass.
+        With in_place, overwritten destination files are truncated before
+        being written so their space is deducted from the required space,
+        which is not the case when files are staged elsewhere (see mirror). '''
+    plan = CopyPlan()
+    for src, dest in fileset:
+        src = sanitize_path(src)
+        if not os.path.isfile(src):
+            continue
+        dest = sanitize_path(dest)
+        up_to_date = skip_up_to_date and dest is not None and _is_up_to_date(src, dest)
+        replaced_size = 0
+        if in_place and dest is not None and os.path.isfile(dest):
+            replaced_size = os.path.getsize(dest)
+        plan.add(os.path.getsize(src), up_to_date, replaced_size)
+    return plan
+
+def check_free_space(path, required_bytes):
+    ''' Checks there is enough free space on the volume path lives on '''
+    path = _get_existing_path(path)
+    free_bytes = shutil.disk_usage(path).free
+    if required_bytes > free_bytes:
+        logging.error('Not enough free space on “%s”: %s required, %s available',
+                      path, format_size(required_bytes), format_size(free_bytes))
+        return False
+    return True
+
+def is_same_volume(first_path, second_path):
+    ''' Checks whether two paths, existing or not yet, live on the same volume '''
+    return os.stat(_get_existing_path(first_path)).st_dev == os.stat(_get_existing_path(second_path)).st_dev
+
+def _get_existing_path(path):
+    # Paths about to be created live on the volume of their deepest existing parent
+    path = os.path.abspath(sanitize_path(path))
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def format_size(size):
+    ''' Formats a byte count for humans '''
+    for unit in [ 'B', 'KiB', 'MiB', 'GiB' ]:
+        if abs(size) < 1024:
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
 def all_map(mapper, fileset):
     ''' Passes all the files in the given fileset and checks it returns true
         for every file '''
@@ -445,6 +599,17 @@ class FileMapper(object):
         except KeyError:
             raise AttributeError(name)
 
+# Supported archive formats, the default one first
+ARCHIVE_EXTENSIONS = [ '.zip', '.tar.zst' ]
+
+def get_archive_extension(archive_location):
+    ''' Returns the extension of an archive among ARCHIVE_EXTENSIONS, or
+        None if it has none of them '''
+    for extension in ARCHIVE_EXTENSIONS:
+        if archive_location.endswith(extension):
+            return extension
+    return None
+
 def list_all_revisions(env, archive_location_format, **override_args):
     ''' Lists all revisions based on pattern '''
 
@@ -470,15 +635,23 @@ def list_all_revisions(env, archive_location_format, **override_args):
     if format_args['configuration'] is None:
         format_args['configuration'] = '*'
 
+    # Archives of a collection can be published in any supported format
+    extensions = [ '' ]
+    archive_extension = get_archive_extension(archive_location_format)
+    if archive_extension is not None:
+        archive_location_format = archive_location_format[:-len(archive_extension)]
+        extensions = ARCHIVE_EXTENSIONS
+
     # Preparing to search (either on a http directory listing or directly with a glob)
     logging.debug('Looking for latest revision in %s…', archive_location_format)
     if is_http:
-        listing_url, _, archive_pattern = archive_location_format.format(**format_args).rpartition("/")
-        archive_regex = fnmatch.translate(archive_pattern)
+        listing_url = archive_location_format.format(**format_args).rpartition("/")[0]
+        archive_capture_regex = _compile_capture_regex(archive_location_format.rpartition("/")[2], format_args, extensions)
     else:
         archive_location_format = sanitize_path(archive_location_format)
         archive_location_format = archive_location_format.replace('\\', '/')
-        archive_glob = archive_location_format.format(**format_args)
+        archive_globs = [ (archive_location_format + extension).format(**format_args) for extension in extensions ]
+        index_globs = [ _format_index_glob(archive_location_format + extension, format_args) for extension in extensions ]
 
     # Preparing for capture after search
     format_args.update({'revision'      : r'(?P<revision>\d+)',
@@ -487,38 +660,52 @@ def list_all_revisions(env, archive_location_format, **override_args):
                         'configuration' : r'(?P<configuration>\w+)'})
 
     if is_http:
-        get_request = requests.get(listing_url)
-        # TODO: test get_request.ok and/or get_request.status_code...
-        listing_content = get_request.text
-        _, _, archive_capture_regex = archive_location_format.format(**format_args).rpartition("/")
-        for line in listing_content.splitlines():
-            extract_revision_info_from_html(revisions_info, listing_url, line, archive_regex, archive_capture_regex)
+        def _parse_listing(listing_content):
+            listing_revisions_info = []
+            extract_revision_info_from_html(listing_revisions_info, listing_url, listing_content, archive_capture_regex)
+            return listing_revisions_info
+        cache_directory = os.path.join(env.root_dir, '.nimp', 'cache', 'listings')
+        revisions_info = nimp.utils.http.fetch_listing(listing_url, cache_directory, _parse_listing,
+                                                       archive_capture_regex.pattern)
     else:
-        archive_capture_regex = archive_location_format.format(**format_args)
-        for archive_path in glob.glob(archive_glob):
-            archive_path = archive_path.replace('\\', '/')
-            extract_revision_info_from_path(revisions_info, archive_path, archive_capture_regex)
-
-    return sorted(revisions_info, key=lambda ri: ri['revision'], reverse = True)
-
-def extract_revision_info_from_html(revisions_info, listing_url, line, archive_regex, archive_capture_regex):
-    ''' Extracts revision info by parsing a line from a html directory listing
-        (looking at anchors) (if it's a match) '''
-    anchor_extractor = '^.*<a href="(?P<anchor_target>.+)">.*$'
-    anchor_match = re.match(anchor_extractor, line)
-
-    if anchor_match is not None:
-        anchor_target = anchor_match.groupdict()['anchor_target']
-        revision_match = re.match(archive_regex, anchor_target)
-        revision_capture_match = re.match(archive_capture_regex, anchor_target)
-
-        if revision_match is not None and revision_capture_match is not None:
+        for extension, archive_glob, index_glob in zip(extensions, archive_globs, index_globs):
+            # Anchored, so files published next to archives are not mistaken for them
+            archive_capture_regex = (archive_location_format + extension).format(**format_args) + r'\Z'
+            indexed_archives = load_index(index_glob)
+            # Missing or stale indexes are rebuilt, so only this listing globs,
+            # unless the repository is a read-only mirror
+            if indexed_archives is None and _can_write_index(index_glob) and build_index(index_glob):
+                indexed_archives = load_index(index_glob)
+            if indexed_archives is not None:
+                for archive_path, creation_time in indexed_archives.items():
+                    if fnmatch.fnmatch(archive_path, archive_glob):
+                        extract_revision_info_from_path(revisions_info, archive_path, archive_capture_regex, creation_time)
+            else:
+                for archive_path in glob.glob(archive_glob):
+                    archive_path = archive_path.replace('\\', '/')
+                    extract_revision_info_from_path(revisions_info, archive_path, archive_capture_regex)
+
+    # Zip archives come first for a same revision, so they are preferred
+    # whatever the order of the listing
+    return sorted(revisions_info, key=lambda ri: (-int(ri['revision']), _get_extension_rank(ri['location'])))
+
+def _get_extension_rank(archive_location):
+    extension = get_archive_extension(archive_location)
+    return ARCHIVE_EXTENSIONS.index(extension) if extension is not None else 0
+
+def extract_revision_info_from_html(revisions_info, listing_url, listing_content, archive_capture_regex):
+    ''' Extracts revision info from the anchors of a html directory listing
+        matching the given compiled regex (see _compile_capture_regex) '''
+    for anchor_match in _ANCHOR_REGEX.finditer(listing_content):
+        anchor_target = anchor_match.group('anchor_target')
+        revision_capture_match = archive_capture_regex.match(anchor_target)
+        if revision_capture_match is not None:
             revision_info = revision_capture_match.groupdict()
             revision_info['is_http'] = True
             revision_info['location'] = '/'.join([listing_url, anchor_target])
             revisions_info += [revision_info]
 
-def extract_revision_info_from_path(revisions_info, archive_path, archive_capture_regex):
+def extract_revision_info_from_path(revisions_info, archive_path, archive_capture_regex, creation_time = None):
     ''' Extracts revision info from a filename (if it's a match) '''
     revision_match = re.match(archive_capture_regex, archive_path)
 
@@ -526,18 +713,174 @@ def extract_revision_info_from_path(revisions_info, archive_path, archive_captur
         revision_info = revision_match.groupdict()
         revision_info['is_http'] = False
         revision_info['location'] = archive_path
-        revision_info['creation_date'] = datetime.date.fromtimestamp(os.path.getctime(archive_path))
+        if creation_time is None:
+            creation_time = os.path.getctime(archive_path)
+        revision_info['creation_date'] = datetime.date.fromtimestamp(creation_time)
         revisions_info += [revision_info]
 
+def update_revision_index(env, archive_location_format):
+    ''' Refreshes the index used by list_all_revisions, to be called after
+        publishing an archive '''
+    archive_location_format = sanitize_path(archive_location_format).replace('\\', '/')
+    format_args = vars(env).copy()
+    return build_index(_format_index_glob(archive_location_format, format_args))
+
+def get_index_path(archive_glob):
+    ''' Returns the path of the index file of the artifact collection
+        matching the given glob '''
+    base_directory, pattern = _split_glob(archive_glob)
+    pattern_hash = hashlib.md5(pattern.encode('utf8')).hexdigest()
+    return os.path.join(base_directory or '.', '.nimp', 'index_%s.json' % pattern_hash)
+
+def build_index(archive_glob):
+    ''' Lists the archives matching the given glob and saves them to the
+        collection index. Archives already known keep their recorded
+        creation time, so only new ones are looked at. '''
+    base_directory, pattern = _split_glob(archive_glob)
+    index_path = get_index_path(archive_glob)
+    previous_index = _read_index(index_path) or {}
+    previous_archives = previous_index.get('archives', {})
+
+    try:
+        # Created first, so writing the index does not touch the directories
+        # it records
+        safe_makedirs(os.path.dirname(index_path))
+
+        # Directories are looked at before being listed: an archive published
+        # in the meantime makes the index stale rather than missing from it
+        directories = _stat_directories(base_directory, pattern)
+        archives = {}
+        for archive_path in glob.glob(archive_glob):
+            relative_path = _relative(base_directory, archive_path)
+            creation_time = previous_archives.get(relative_path)
+            archives[relative_path] = creation_time if creation_time is not None else os.path.getctime(archive_path)
+
+        index_tmp = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(index_tmp, 'w') as index_file:
+            json.dump({ 'pattern': pattern, 'directories': directories, 'archives': archives }, index_file)
+        os.replace(index_tmp, index_path)
+    except OSError as ex:
+        logging.warning('Unable to update artifact index %s: %s', index_path, ex)
+        return False
+
+    logging.debug('Indexed %d archives in %s', len(archives), index_path)
+    return True
+
+def load_index(archive_glob):
+    ''' Returns a dictionary of archive paths matching the given glob to their
+        creation time, or None if the collection index is missing or stale '''
+    base_directory, pattern = _split_glob(archive_glob)
+    index_path = get_index_path(archive_glob)
+    index = _read_index(index_path)
+    if index is None or index.get('pattern') != pattern:
+        logging.debug('No artifact index found at %s', index_path)
+        return None
+
+    if _stat_directories(base_directory, pattern) != index['directories']:
+        logging.debug('Artifact index %s is stale', index_path)
+        return None
+
+    return { _join(base_directory, relative_path): creation_time
+             for relative_path, creation_time in index['archives'].items() }
+
+def _can_write_index(archive_glob):
+    index_directory = os.path.dirname(get_index_path(archive_glob))
+    writable_directory = index_directory if os.path.isdir(index_directory) else os.path.dirname(index_directory)
+    if os.access(writable_directory, os.W_OK):
+        return True
+    logging.debug('Not rebuilding artifact index in read-only directory %s', writable_directory)
+    return False
+
+def _read_index(index_path):
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with open(index_path, 'r') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError) as ex:
+        logging.warning('Ignoring unreadable artifact index %s: %s', index_path, ex)
+        return None
+
+def _split_glob(archive_glob):
+    # Base directory is the deepest one without any wildcard
+    wildcard_positions = [ archive_glob.find(char) for char in '*?[' if char in archive_glob ]
+    first_wildcard = min(wildcard_positions) if wildcard_positions else len(archive_glob)
+    base_directory = archive_glob[:first_wildcard].rpartition('/')[0]
+    return base_directory, archive_glob[len(base_directory) + 1 if base_directory else 0:]
+
+def _join(base_directory, relative_path):
+    return '/'.join(part for part in [ base_directory, relative_path ] if part)
+
+def _relative(base_directory, path):
+    path = path.replace('\\', '/')
+    return path[len(base_directory):].lstrip('/') if base_directory else path
+
+def _stat_directories(base_directory, pattern):
+    # Every directory archives can be published to, including intermediate
+    # ones, since adding an entry to a directory updates its mtime
+    directories = {}
+    levels = pattern.split('/')[:-1]
+    for depth in range(len(levels) + 1):
+        for directory in glob.glob(_join(base_directory, '/'.join(levels[:depth])) or '.'):
+            if os.path.isdir(directory):
+                directories[_relative(base_directory, directory)] = os.stat(directory).st_mtime_ns
+    return directories
+
+_ANCHOR_REGEX = re.compile(r'<a href="(?P<anchor_target>[^"]+)"')
+
+_CAPTURE_PATTERNS = {'revision'      : r'\d+',
+                     'platform'      : r'\w+',
+                     'dlc'           : r'\w+',
+                     'configuration' : r'\w+'}
+
+def _compile_capture_regex(archive_pattern_format, format_args, extensions = None):
+    # One regex both filters archive names and captures their revision
+    # info: fields set to '*' are captured, other ones must match exactly.
+    # Archive names may end with any of the given extensions.
+    regex = ''
+    captured_fields = set()
+    formatter = string.Formatter()
+    for literal, field_name, format_spec, _ in formatter.parse(archive_pattern_format):
+        regex += re.escape(literal)
+        if field_name is None:
+            continue
+        value, _ = formatter.get_field(field_name, (), format_args)
+        if field_name not in _CAPTURE_PATTERNS:
+            regex += re.escape(format(value, format_spec))
+        elif field_name in captured_fields:
+            regex += '(?P=%s)' % field_name
+        else:
+            captured_fields.add(field_name)
+            field_regex = _CAPTURE_PATTERNS[field_name] if value == '*' else re.escape(str(value))
+            regex += '(?P<%s>%s)' % (field_name, field_regex)
+    if extensions:
+        regex += '(?:%s)' % '|'.join(re.escape(extension) for extension in extensions)
+    return re.compile(regex + r'\Z')
+
+def _format_index_glob(archive_location_format, format_args):
+    # Indexes cover the whole collection, whatever revision is looked for
+    format_args = format_args.copy()
+    format_args.update({'revision' : '*', 'platform' : '*', 'dlc' : '*', 'configuration' : '*'})
+    return archive_location_format.format(**format_args)
+
+def find_latest_revision(revisions_info, max_revision = None, min_revision = None):
+    ''' Returns the info of the latest revision between given bounds from a
+        listing of list_all_revisions, or None '''
+    # Listings are sorted latest first, so the first match is the latest one
+    for revision_info in revisions_info:
+        revision = int(revision_info['revision'])
+        if ((max_revision is None or revision <= int(max_revision)) and
+                (min_revision is None or revision >= int(min_revision))):
+            return revision_info
+    return None
+
 def get_latest_available_revision(env, archive_location_format, max_revision, min_revision, **override_args):
     ''' Returns the latest available revision based on pattern '''
     revisions_info = list_all_revisions(env, archive_location_format, **override_args)
-    for revision_info in revisions_info:
-        revision = revision_info['revision']
-        if ((max_revision is None or int(revision) <= int(max_revision)) and
-                (min_revision is None or int(revision) >= int(min_revision))):
-            logging.debug('Found revision %s', revision)
-            return revision_info
+    revision_info = find_latest_revision(revisions_info, max_revision, min_revision)
+    if revision_info is not None:
+        logging.debug('Found revision %s', revision_info['revision'])
+        return revision_info
 
     revisions = [revision_info['revision'] for revision_info in revisions_info]
     candidates_desc = (' Candidates were: %s' % ' '.join(revisions)) if revisions_info else ''
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Archive utilities unit tests '''
+
+import hashlib
+import io
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+
+import nimp.utils.archive
+
+class _UnseekableStream(object):
+    ''' Write-only or read-only stream that cannot seek, like a socket '''
+    def __init__(self, stream, read_size = None):
+        self._stream = stream
+        self._read_size = read_size
+
+    def read(self, size = -1):
+        ''' Reads at most read_size bytes at once, if set '''
+        if self._read_size is not None:
+            size = min(size, self._read_size)
+        return self._stream.read(size)
+
+    def write(self, data):
+        ''' Writes to the underlying stream '''
+        return self._stream.write(data)
+
+    def flush(self):
+        ''' Nothing to flush '''
+
+def _create_zip(files, compression = zipfile.ZIP_DEFLATED, seekable = True):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output if seekable else _UnseekableStream(output), 'w', compression = compression) as archive_file:
+        for name, content in files:
+            archive_file.writestr(name, content)
+    return output.getvalue()
+
+class _StreamExtractTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.destination = self._tmp_dir.name
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _stream_extract(self, archive, handle_zip_of_zips = False):
+        stream = _UnseekableStream(io.BytesIO(archive), read_size = 7)
+        extracted = nimp.utils.archive.stream_extract(stream, self.destination, handle_zip_of_zips)
+        return sorted(os.path.relpath(path, self.destination).replace(os.sep, '/') for path in extracted)
+
+    def _read(self, name):
+        with open(os.path.join(self.destination, name), 'rb') as extracted_file:
+            return extracted_file.read()
+
+    def test_stream_extract(self):
+        ''' Stored and deflated entries, with or without data descriptors,
+            should be extracted from a stream. '''
+        files = [ ('a.txt', b'a' * 100000), ('dir/', b''), ('dir/b.bin', os.urandom(5000)) ]
+        for compression, seekable in [ (zipfile.ZIP_STORED, True), (zipfile.ZIP_DEFLATED, True), (zipfile.ZIP_DEFLATED, False) ]:
+            archive = _create_zip(files, compression, seekable)
+            self.assertEqual(self._stream_extract(archive), [ 'a.txt', 'dir/b.bin' ])
+            self.assertEqual(self._read('dir/b.bin'), files[2][1])
+            self.assertEqual(self._read('a.txt'), files[0][1])
+
+    def test_stream_extract_zip_of_zips(self):
+        ''' Nested archives should be extracted on the fly. '''
+        archive = _create_zip([ ('one.zip', _create_zip([ ('one.txt', b'1') ])),
+                                ('two.zip', _create_zip([ ('two.txt', b'2') ], seekable = False)) ],
+                              compression = zipfile.ZIP_STORED)
+        self.assertEqual(self._stream_extract(archive, handle_zip_of_zips = True), [ 'one.txt', 'two.txt' ])
+
+    def test_stream_unsupported(self):
+        ''' Stored entries of unknown size cannot be streamed. '''
+        archive = _create_zip([ ('a.txt', b'a') ], zipfile.ZIP_STORED, seekable = False)
+        with self.assertRaises(nimp.utils.archive.StreamingNotSupportedError):
+            self._stream_extract(archive)
+
+    def test_stream_extract_corrupted(self):
+        ''' Corrupted entries should be detected. '''
+        archive = bytearray(_create_zip([ ('a.txt', b'a' * 1000) ], zipfile.ZIP_STORED))
+        archive[100] ^= 0xFF
+        with self.assertRaises(zipfile.BadZipFile):
+            self._stream_extract(bytes(archive))
+
+class _OpenMemberTests(unittest.TestCase):
+    def test_open_member(self):
+        ''' Nested archives should be readable without loading them in
+            memory, whether they are stored or deflated. '''
+        inner_archive = _create_zip([ ('a.txt', b'a' * 1000), ('b.txt', b'b') ])
+        for compression in [ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]:
+            outer_view = nimp.utils.archive.FileView(io.BytesIO(_create_zip([ ('inner.zip', inner_archive) ], compression)))
+            with zipfile.ZipFile(outer_view) as outer_file:
+                with nimp.utils.archive.open_member(outer_file, outer_file.getinfo('inner.zip')) as member_file:
+                    self.assertEqual(isinstance(member_file, nimp.utils.archive.FileView), compression == zipfile.ZIP_STORED)
+                    with zipfile.ZipFile(member_file) as inner_file:
+                        self.assertEqual(inner_file.read('b.txt'), b'b')
+                        self.assertEqual(inner_file.read('a.txt'), b'a' * 1000)
+
+    def test_concurrent_views(self):
+        ''' Views of a same file should keep their own position. '''
+        first_view = nimp.utils.archive.FileView(io.BytesIO(b'0123456789'), 2)
+        second_view = nimp.utils.archive.FileView(first_view, 4, 3)
+        self.assertEqual(first_view.read(2), b'23')
+        self.assertEqual(second_view.read(), b'678')
+        self.assertEqual(first_view.read(2), b'45')
+
+class _ParallelZipWriterTests(unittest.TestCase):
+    def test_parallel_zip_writer(self):
+        ''' Files deflated on several threads should make a standard zip,
+            whether it is written to a file or to a stream. '''
+        files = [ ('large.bin', os.urandom(3000) * 100), ('empty.txt', b''), ('stored.txt', b'stored'), ('text.txt', b'text' * 5000) ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, content in files:
+                with open(os.path.join(tmp_dir, name), 'wb') as output:
+                    output.write(content)
+            for seekable in [ True, False ]:
+                output = io.BytesIO()
+                with zipfile.ZipFile(output if seekable else _UnseekableStream(output), 'w') as archive_file:
+                    with nimp.utils.archive.ParallelZipWriter(archive_file, 4, chunk_size = 16 * 1024) as archive_writer:
+                        for name, content in files:
+                            info = zipfile.ZipInfo.from_file(os.path.join(tmp_dir, name), name)
+                            info.compress_type = zipfile.ZIP_STORED if name == 'stored.txt' else zipfile.ZIP_DEFLATED
+                            file_hash = archive_writer.add(os.path.join(tmp_dir, name), info)
+                            self.assertEqual(file_hash, hashlib.sha256(content).hexdigest())
+
+                with zipfile.ZipFile(io.BytesIO(output.getvalue())) as archive_file:
+                    self.assertIsNone(archive_file.testzip())
+                    self.assertEqual([ info.filename for info in archive_file.infolist() ], [ name for name, _ in files ])
+                    for name, content in files:
+                        self.assertEqual(archive_file.read(name), content)
+                    self.assertLess(archive_file.getinfo('large.bin').compress_size, 3000 * 2)
+                    self.assertEqual(archive_file.getinfo('stored.txt').compress_type, zipfile.ZIP_STORED)
+                if seekable:
+                    self.assertEqual(self._stream_extract_names(output.getvalue()), sorted(name for name, _ in files))
+
+    def test_pending_entries(self):
+        ''' The zip file should not be written to while entries are pending,
+            and unsupported compression methods should be rejected. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'large.bin')
+            with open(filename, 'wb') as output:
+                output.write(os.urandom(64 * 1024))
+            with zipfile.ZipFile(io.BytesIO(), 'w') as archive_file:
+                with nimp.utils.archive.ParallelZipWriter(archive_file, 1, chunk_size = 1024) as archive_writer:
+                    archive_writer.add(filename, zipfile.ZipInfo.from_file(filename, 'large.bin'))
+                    with self.assertRaises(ValueError):
+                        archive_file.writestr('other.txt', b'other')
+                    info = zipfile.ZipInfo.from_file(filename, 'bzip2.bin')
+                    info.compress_type = zipfile.ZIP_BZIP2
+                    with self.assertRaises(ValueError):
+                        archive_writer.add(filename, info)
+                archive_file.writestr('other.txt', b'other')
+                self.assertEqual(archive_file.namelist(), [ 'large.bin', 'other.txt' ])
+
+    @staticmethod
+    def _stream_extract_names(archive):
+        with tempfile.TemporaryDirectory() as destination:
+            extracted = nimp.utils.archive.stream_extract(io.BytesIO(archive), destination)
+            return sorted(os.path.relpath(path, destination) for path in extracted)
+
+class _TimestampTests(unittest.TestCase):
+    def test_entry_mtime(self):
+        ''' Modification times should be read from extra fields when there
+            are some, and from the entry date_time otherwise. '''
+        mtime = 1500000000123456700
+        extra = nimp.utils.archive.get_timestamp_extra(mtime)
+        self.assertEqual(nimp.utils.archive.get_entry_mtime((1980, 1, 1, 0, 0, 0), extra), mtime)
+        unix_extra = b'UT\x05\x00\x01' + (1500000000).to_bytes(4, 'little')
+        self.assertEqual(nimp.utils.archive.get_entry_mtime((1980, 1, 1, 0, 0, 0), unix_extra), 1500000000 * 1000000000)
+        date_time = (2017, 7, 14, 2, 40, 0)
+        self.assertEqual(time.localtime(nimp.utils.archive.get_entry_mtime(date_time, b'') // 1000000000)[:6], date_time)
+
+    def test_stream_extract_mtime(self):
+        ''' Streamed extraction should restore modification times. '''
+        info = zipfile.ZipInfo('a.txt', (2017, 7, 14, 2, 40, 0))
+        info.extra = nimp.utils.archive.get_timestamp_extra(1500000000123456700)
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as archive_file:
+            archive_file.writestr(info, b'a')
+        with tempfile.TemporaryDirectory() as destination:
+            for filename in nimp.utils.archive.stream_extract(io.BytesIO(output.getvalue()), destination):
+                self.assertEqual(os.stat(filename).st_mtime_ns, 1500000000123456700)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Artifact repository unit tests '''
+
+import hashlib
+import os
+import tempfile
+import types
+import unittest
+import unittest.mock
+import zipfile
+
+import nimp.artifacts
+import nimp.system
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w'):
+        pass
+
+class _IndexTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.repository = self._tmp_dir.name.replace('\\', '/')
+        self.archive_format = self.repository + '/bin/{platform}/bin-{configuration}-{revision}.zip'
+        self.env = types.SimpleNamespace(revision = None, platform = None, configuration = None, dlc = None)
+        for platform, revision in [ ('win64', '9'), ('win64', '10'), ('linux', '10') ]:
+            _touch(self.archive_format.format(platform = platform, configuration = 'devel', revision = revision))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _list_revisions(self, **override_args):
+        revisions_info = nimp.system.list_all_revisions(self.env, self.archive_format, **override_args)
+        return sorted((info['platform'], info['revision']) for info in revisions_info)
+
+    def test_index(self):
+        ''' Revisions listed from the index should match the ones globbed. '''
+        index_glob = self.repository + '/bin/*/bin-*-*.zip'
+        self.assertIsNone(nimp.system.load_index(index_glob))
+        expected = self._list_revisions()
+
+        self.assertTrue(nimp.system.update_revision_index(self.env, self.archive_format))
+        self.assertEqual(len(nimp.system.load_index(index_glob)), 3)
+        self.assertEqual(self._list_revisions(), expected)
+        self.assertEqual(self._list_revisions(platform = 'linux'), [ ('linux', '10') ])
+
+    def test_stale_index(self):
+        ''' Index should be ignored once an archive is published without
+            updating it. '''
+        nimp.system.update_revision_index(self.env, self.archive_format)
+        _touch(self.archive_format.format(platform = 'mac', configuration = 'devel', revision = '11'))
+        self.assertIsNone(nimp.system.load_index(self.repository + '/bin/*/bin-*-*.zip'))
+        self.assertIn(('mac', '11'), self._list_revisions())
+
+    def test_rebuilt_index(self):
+        ''' Listing revisions should rebuild a missing or stale index. '''
+        index_glob = self.repository + '/bin/*/bin-*-*.zip'
+        self._list_revisions()
+        self.assertEqual(len(nimp.system.load_index(index_glob)), 3)
+        _touch(self.archive_format.format(platform = 'mac', configuration = 'devel', revision = '11'))
+        self.assertIn(('mac', '11'), self._list_revisions())
+        self.assertEqual(len(nimp.system.load_index(index_glob)), 4)
+
+    def test_read_only_index(self):
+        ''' Listing revisions should not write an index into a read-only
+            repository. '''
+        with unittest.mock.patch('os.access', return_value = False):
+            self.assertEqual(len(self._list_revisions()), 3)
+        self.assertFalse(os.path.exists(os.path.join(self.repository, '.nimp')))
+
+    def test_delta_archives(self):
+        ''' Deltas should not be listed as revisions of their own. '''
+        archive_path = self.archive_format.format(platform = 'linux', configuration = 'devel', revision = '11')
+        _touch(nimp.artifacts.get_delta_location(archive_path, 10))
+        self.assertEqual(self._list_revisions(platform = 'linux'), [ ('linux', '10') ])
+        _touch(archive_path)
+        latest = nimp.system.get_latest_available_revision(self.env, self.archive_format, None, None, platform = 'linux')
+        self.assertEqual(latest['location'], archive_path)
+
+    def test_archive_formats(self):
+        ''' Revisions should be listed whatever the format of their archive,
+            ignoring files published next to archives. '''
+        tar_zst_path = self.archive_format.format(platform = 'linux', configuration = 'devel', revision = '11')[:-len('.zip')] + '.tar.zst'
+        _touch(tar_zst_path)
+        _touch(nimp.artifacts.get_delta_location(self.archive_format.format(platform = 'linux', configuration = 'devel', revision = '10'), 9))
+        self.assertEqual(self._list_revisions(platform = 'linux'), [ ('linux', '10'), ('linux', '11') ])
+        latest = nimp.system.get_latest_available_revision(self.env, self.archive_format, None, None)
+        self.assertEqual(latest['location'], tar_zst_path)
+
+class _FindLatestRevisionTests(unittest.TestCase):
+    def test_find_latest_revision(self):
+        ''' Latest revision should be found numerically, within bounds. '''
+        revisions_info = [ { 'revision': revision } for revision in [ '100', '12', '10', '9' ] ]
+        self.assertEqual(nimp.system.find_latest_revision(revisions_info)['revision'], '100')
+        self.assertEqual(nimp.system.find_latest_revision(revisions_info, max_revision = '99')['revision'], '12')
+        self.assertEqual(nimp.system.find_latest_revision(revisions_info, max_revision = '11', min_revision = '10')['revision'], '10')
+        self.assertIsNone(nimp.system.find_latest_revision(revisions_info, max_revision = '99', min_revision = '13'))
+
+class _ArchiveCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = nimp.artifacts.ArchiveCache(os.path.join(self._tmp_dir.name, 'cache'), 250)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _insert(self, name, size, access_time):
+        archive_path = os.path.join(self._tmp_dir.name, name)
+        with open(archive_path, 'wb') as archive_file:
+            archive_file.write(b'0' * size)
+        cached_path = self.cache.insert(name, archive_path)
+        os.utime(cached_path, (access_time, access_time))
+        return cached_path
+
+    def test_get_key(self):
+        ''' Archives should be identified by their hash, or else by their
+            location and validator. '''
+        archive_hash = hashlib.sha256(b'archive').hexdigest()
+        self.assertEqual(nimp.artifacts.ArchiveCache.get_key('http://a/x.zip', archive_hash),
+                         nimp.artifacts.ArchiveCache.get_key('http://b/x.zip', archive_hash))
+        self.assertNotEqual(nimp.artifacts.ArchiveCache.get_key('http://a/x.zip', archive_hash),
+                            nimp.artifacts.ArchiveCache.get_key('http://a/x.tar.zst', archive_hash))
+        self.assertIsNotNone(nimp.artifacts.ArchiveCache.get_key('http://a/x.zip', validator = { 'etag': '"1"' }))
+        self.assertIsNone(nimp.artifacts.ArchiveCache.get_key('http://a/x.zip', validator = { 'etag': None, 'last_modified': None }))
+
+    def test_eviction(self):
+        ''' Least recently used archives should be evicted first. '''
+        first_path = self._insert('first', 100, 1000)
+        second_path = self._insert('second', 100, 2000)
+        self.assertEqual(self.cache.get('first'), first_path)
+        self._insert('third', 100, 3000)
+        self.assertIsNone(self.cache.get('second'))
+        self.assertIsNotNone(self.cache.get('first'))
+        self.assertIsNotNone(self.cache.get('third'))
+        self.assertFalse(os.path.exists(second_path))
+
+    def test_eviction_grace_period(self):
+        ''' Archives recently used or being inserted should not be evicted. '''
+        first_path = self._insert('first', 200, 1000)
+        tmp_path = first_path + '.0123.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(b'0' * 200)
+        self.cache.evict()
+        self.assertTrue(os.path.exists(tmp_path))
+        self.assertIsNotNone(self.cache.get('first'))
+        self._insert('second', 100, 2000)
+        self.assertIsNotNone(self.cache.get('first'))
+
+class _CompressionPolicyTests(unittest.TestCase):
+    def test_get_compression(self):
+        ''' Files should be deflated unless they are known or probed to be
+            compressed already, and some always should. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = { 'random.bin': os.urandom(64 * 1024), 'text.bin': b'text' * 1024,
+                      'text.png': b'text' * 1024, 'symbols.pdb': os.urandom(1024) }
+            for name, content in files.items():
+                with open(os.path.join(tmp_dir, name), 'wb') as output:
+                    output.write(content)
+
+            def _get_compressions(policy):
+                return { name: policy.get_compression(os.path.join(tmp_dir, name)) == zipfile.ZIP_DEFLATED for name in files }
+
+            self.assertEqual(_get_compressions(nimp.artifacts.CompressionPolicy(True)),
+                             { 'random.bin': False, 'text.bin': True, 'text.png': False, 'symbols.pdb': True })
+            self.assertEqual(_get_compressions(nimp.artifacts.CompressionPolicy(False)),
+                             { 'random.bin': False, 'text.bin': False, 'text.png': False, 'symbols.pdb': True })
+
+            env = types.SimpleNamespace(compress = True, artifact_compression_policy = { 'store': [ '.BIN' ], 'deflate': [] })
+            self.assertEqual(_get_compressions(nimp.artifacts.CompressionPolicy.from_env(env)),
+                             { 'random.bin': False, 'text.bin': False, 'text.png': True, 'symbols.pdb': False })
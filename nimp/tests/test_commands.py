@@ -22,9 +22,20 @@
 
 ''' System utilities unit tests '''
 
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import stat
+import tempfile
 import unittest
 import unittest.mock
+import zipfile
 
+import nimp.artifacts
+import nimp.system
 import nimp.tests.utils
 import nimp.nimp_cli
 
@@ -34,3 +45,403 @@ class _CommandTests(unittest.TestCase):
         ''' Checks if adding files to perforce is working '''
         self.assertEqual(nimp.nimp_cli.main(['nimp', 'check', 'processes']), 0)
         self.assertEqual(nimp.nimp_cli.main(['nimp', 'check', 'status']), 0)
+
+_ARTIFACT_CONF = '''
+config = {
+    'artifact_repository_destination': '%(repository)s',
+    'artifact_repository_source': '%(repository)s',
+    'artifact_collection': { 'binaries': 'binaries/bin-{platform}-{revision}' },
+}
+'''
+
+_BINARIES_FILESET = '''
+def map(files):
+    files.src('bin').to('bin').glob('**')
+'''
+
+class _ManifestRejectingRequestHandler(nimp.tests.utils.WebDavRequestHandler):
+    ''' Accepts uploads of archives but not of their manifest '''
+    def do_PUT(self): #pylint: disable=invalid-name
+        if self.path.endswith('.manifest.json'):
+            self.send_error(403)
+            return
+        super(_ManifestRejectingRequestHandler, self).do_PUT()
+
+class _ArtifactCommandTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._previous_dir = os.getcwd()
+        self.repository = os.path.join(self._tmp_dir.name, 'repository').replace('\\', '/')
+        self.workspace = os.path.join(self._tmp_dir.name, 'workspace')
+        self._write('.nimp.conf', _ARTIFACT_CONF % { 'repository': self.repository })
+        self._write('.nimp/filesets/binaries.txt', _BINARIES_FILESET)
+        self._write('bin/readme.txt', 'hello')
+        self._write('bin/tools/run.sh', '#!/bin/sh\necho hello\n')
+        os.chdir(self.workspace)
+
+    def tearDown(self):
+        os.chdir(self._previous_dir)
+        self._tmp_dir.cleanup()
+
+    def _write(self, path, content):
+        path = os.path.join(self.workspace, path)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w') as output:
+            output.write(content)
+
+    def _read(self, path):
+        with open(os.path.join(self.workspace, path)) as source:
+            return source.read()
+
+    def _upload(self, revision, *args):
+        return nimp.nimp_cli.main([ 'nimp', 'upload-fileset', 'binaries', '-p', 'linux', '-r', revision,
+                                    '-c', 'game/devel', '--archive' ] + list(args))
+
+    def _download(self, *args):
+        return nimp.nimp_cli.main([ 'nimp', 'download-fileset', 'binaries', '-p', 'linux' ] + list(args))
+
+    def test_upload_download(self):
+        ''' A fileset uploaded as an archive should be published with its
+            manifest and downloaded back to the workspace. '''
+        self.assertEqual(self._upload('10'), 0)
+        with open(self.repository + '/binaries/bin-linux-10.zip.manifest.json') as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['revision'], '10')
+        self.assertEqual(sorted(entry['name'] for entry in manifest['entries']), [ 'bin/readme.txt', 'bin/tools/run.sh' ])
+        with open(self.repository + '/binaries/bin-linux-10.zip', 'rb') as archive_file:
+            archive_hash = hashlib.sha256(archive_file.read()).hexdigest()
+        self.assertEqual(nimp.artifacts.load_archive_hash(self.repository + '/binaries/bin-linux-10.zip', False), archive_hash)
+
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download(), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+        self.assertTrue(os.access(os.path.join(self.workspace, 'bin/tools/run.sh'), os.X_OK))
+
+    def test_download_stream(self):
+        ''' Archives served over HTTP should be extracted while downloaded. '''
+        self.assertEqual(self._upload('10'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+            self.assertEqual(self._download('--stream', '--free-parameters', 'artifact_repository_source=' + repository_url), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+        self.assertTrue(os.access(os.path.join(self.workspace, 'bin/tools/run.sh'), os.X_OK))
+
+    def test_download_filtered(self):
+        ''' Filtered downloads should only extract selected files, reading
+            them remotely when the server supports range requests. '''
+        self.assertEqual(self._upload('10'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        with nimp.tests.utils.serve_directory(self.repository, nimp.tests.utils.RangeRequestHandler) as repository_url:
+            self.assertEqual(self._download('--include', 'bin/tools/*', '--free-parameters', 'artifact_repository_source=' + repository_url), 0)
+        self.assertTrue(os.path.isfile(os.path.join(self.workspace, 'bin/tools/run.sh')))
+        self.assertFalse(os.path.exists(os.path.join(self.workspace, 'bin/readme.txt')))
+
+    def test_download_parallel(self):
+        ''' Archives should be compressed and extracted by several workers. '''
+        for index in range(20):
+            self._write('bin/data/file%d.txt' % index, str(index) * index)
+        self.assertEqual(self._upload('10', '--compress', '--jobs', '4'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download('--jobs', '4'), 0)
+        for index in range(20):
+            self.assertEqual(self._read('bin/data/file%d.txt' % index), str(index) * index)
+
+    def test_download_nested_plan(self):
+        ''' Free space needed by nested archives should be planned from
+            their entries, not from the nested archives themselves. '''
+        inner_archive = io.BytesIO()
+        with zipfile.ZipFile(inner_archive, 'w', zipfile.ZIP_DEFLATED) as inner_file:
+            inner_file.writestr('bin/data.txt', 'a' * 100000)
+        archive_path = self.repository + '/binaries/bin-linux-10.zip'
+        os.makedirs(os.path.dirname(archive_path))
+        with zipfile.ZipFile(archive_path, 'w') as archive_file:
+            archive_file.writestr('data.zip', inner_archive.getvalue())
+        nimp.artifacts.write_manifest(archive_path, {}, revision = '10')
+
+        with unittest.mock.patch('nimp.system.check_free_space', return_value = True) as check_free_space:
+            self.assertEqual(self._download(), 0)
+        self.assertEqual([ call[0][1] for call in check_free_space.call_args_list ], [ 100000 ])
+        self.assertEqual(self._read('bin/data.txt'), 'a' * 100000)
+
+    def test_download_space(self):
+        ''' Free space should be checked for downloaded archives along with
+            the files extracted from them, sharing the same volume. '''
+        self.assertEqual(self._upload('10'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        archive_size = os.path.getsize(self.repository + '/binaries/bin-linux-10.zip')
+        with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+            with unittest.mock.patch('nimp.system.check_free_space', return_value = True) as check_free_space:
+                self.assertEqual(self._download('--free-parameters', 'artifact_repository_source=' + repository_url, 'game=Game'), 0)
+        self.assertEqual([ call[0][1] for call in check_free_space.call_args_list ], [ 26, archive_size + 26 ])
+
+    def test_download_incremental(self):
+        ''' Files already up to date should not be rewritten, and files no
+            longer deployed should be removed when pruning. '''
+        self._write('bin/obsolete.txt', 'obsolete')
+        self.assertEqual(self._upload('10'), 0)
+        self.assertEqual(self._download(), 0)
+        os.remove(os.path.join(self.workspace, 'bin/obsolete.txt'))
+        self.assertEqual(self._upload('11'), 0)
+        self._write('bin/obsolete.txt', 'obsolete')
+        self._write('bin/unrelated.txt', 'unrelated')
+
+        readme_path = os.path.join(self.workspace, 'bin/readme.txt')
+        os.utime(readme_path, (0, 0))
+        self._write('bin/tools/run.sh', 'modified')
+        self.assertEqual(self._download('--prune'), 0)
+        self.assertEqual(os.stat(readme_path).st_mtime, 0)
+        self.assertEqual(self._read('bin/tools/run.sh'), '#!/bin/sh\necho hello\n')
+        self.assertFalse(os.path.exists(os.path.join(self.workspace, 'bin/obsolete.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.workspace, 'bin/unrelated.txt')))
+
+    def test_download_cache(self):
+        ''' Archives downloaded once should be reused from the machine-wide
+            cache. '''
+        self.assertEqual(self._upload('10'), 0)
+        cache_directory = os.path.join(self._tmp_dir.name, 'cache')
+        with nimp.tests.utils.serve_directory(self.repository, nimp.tests.utils.RangeRequestHandler) as repository_url:
+            parameters = [ '--free-parameters', 'artifact_repository_source=' + repository_url, 'game=Game',
+                           'artifact_cache_directory=' + cache_directory ]
+            sent_bytes = []
+            for _ in range(2):
+                shutil.rmtree(os.path.join(self.workspace, 'bin'))
+                nimp.tests.utils.RangeRequestHandler.sent_bytes = 0
+                self.assertEqual(self._download(*parameters), 0)
+                self.assertEqual(self._read('bin/readme.txt'), 'hello')
+                sent_bytes.append(nimp.tests.utils.RangeRequestHandler.sent_bytes)
+        archive_size = os.path.getsize(self.repository + '/binaries/bin-linux-10.zip')
+        self.assertLessEqual(sent_bytes[1], sent_bytes[0] - archive_size)
+        self.assertEqual(len([ filename for _, _, filenames in os.walk(cache_directory) for filename in filenames ]), 1)
+
+    def test_download_cache_identity(self):
+        ''' Archives with the same entries but different bytes should not
+            share a cache entry, and cached archives not matching their hash
+            should be downloaded again. '''
+        self.assertEqual(self._upload('10'), 0)
+        os.utime(os.path.join(self.workspace, 'bin/readme.txt'), (10 ** 9, 10 ** 9))
+        self.assertEqual(self._upload('11'), 0)
+        cache_directory = os.path.join(self._tmp_dir.name, 'cache')
+        with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+            parameters = [ '--free-parameters', 'artifact_repository_source=' + repository_url, 'game=Game',
+                           'artifact_cache_directory=' + cache_directory ]
+            for revision in [ '10', '11' ]:
+                self.assertEqual(self._download(*([ '-r', revision ] + parameters)), 0)
+            cached_paths = [ os.path.join(directory, filename) for directory, _, filenames in os.walk(cache_directory) for filename in filenames ]
+            self.assertEqual(len(cached_paths), 2)
+            for cached_path in cached_paths:
+                with open(cached_path, 'r+b') as cached_file:
+                    cached_file.write(b'corrupted')
+            self.assertEqual(self._download(*([ '-r', '11', '--force' ] + parameters)), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+
+    def test_download_hash(self):
+        ''' Archives should be checked against their published hash, whether
+            read locally, from the cache or while streamed. '''
+        self.assertEqual(self._upload('10'), 0)
+        cache_directory = os.path.join(self._tmp_dir.name, 'cache')
+        with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+            http_source = [ '--free-parameters', 'artifact_repository_source=' + repository_url, 'game=Game' ]
+            self.assertEqual(self._download(*(http_source + [ 'artifact_cache_directory=' + cache_directory ])), 0)
+            nimp.artifacts.write_archive_hash(self.repository + '/binaries/bin-linux-10.zip', '0' * 64)
+            for parameters in [ [], http_source + [ 'artifact_cache_directory=' + cache_directory ], [ '--stream' ] + http_source ]:
+                self.assertNotEqual(self._download(*([ '--force' ] + parameters)), 0)
+
+    def test_download_permissions(self):
+        ''' Executables should be detected from the modes stored in archives,
+            or else from their header. '''
+        self._write('bin/tool', '\x7fELF')
+        self._write('bin/launcher', 'launch')
+        # Read-only, as files synced from Perforce are
+        os.chmod(os.path.join(self.workspace, 'bin/launcher'), 0o555)
+        self.assertEqual(self._upload('10'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download(), 0)
+        for name, is_executable in [ ('tool', True), ('launcher', True), ('readme.txt', False) ]:
+            self.assertEqual(os.access(os.path.join(self.workspace, 'bin', name), os.X_OK), is_executable)
+        # Only exec bits are restored, so files can be extracted again
+        self.assertTrue(os.stat(os.path.join(self.workspace, 'bin/launcher')).st_mode & stat.S_IWUSR)
+
+    def test_download_mtime(self):
+        ''' Extracted files should keep the modification time they had when
+            uploaded. '''
+        readme_path = os.path.join(self.workspace, 'bin/readme.txt')
+        os.utime(readme_path, ns = (1500000000123456700, 1500000000123456700))
+        self.assertEqual(self._upload('10'), 0)
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download(), 0)
+        self.assertEqual(os.stat(readme_path).st_mtime_ns, 1500000000123456700)
+
+    def test_download_mirror(self):
+        ''' Archives should be fetched from the fastest source having them,
+            ignoring mirrors which do not match the reference manifest. '''
+        self.assertEqual(self._upload('10'), 0)
+        mirror = os.path.join(self._tmp_dir.name, 'mirror').replace('\\', '/')
+        shutil.copytree(self.repository, mirror)
+        stale_mirror = os.path.join(self._tmp_dir.name, 'stale_mirror').replace('\\', '/')
+        self._write('bin/readme.txt', 'stale')
+        self.assertEqual(self._upload('10', '--free-parameters', 'artifact_repository_destination=' + stale_mirror), 0)
+
+        with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+            for sources in [ [ mirror, repository_url ], [ stale_mirror, repository_url ] ]:
+                shutil.rmtree(os.path.join(self.workspace, 'bin'))
+                arguments = [ argument for source in sources for argument in [ '--source', source ] ]
+                self.assertEqual(self._download(*(arguments + [ '--free-parameters', 'game=Game' ])), 0)
+                self.assertEqual(self._read('bin/readme.txt'), 'hello')
+                # Only HTTP downloads go through the download directory
+                self.assertEqual(os.path.exists(os.path.join(self.workspace, 'Game')), sources[0] == stale_mirror)
+
+    @unittest.skipIf(nimp.system.try_import('zstandard') is None, 'zstandard python module is not installed')
+    def test_download_stale_mirror(self):
+        ''' Mirrors publishing stale archives with their own hash should be
+            ignored, whatever their format and even when streamed. '''
+        self.assertEqual(self._upload('10'), 0)
+        self._write('bin/readme.txt', 'stale')
+        stale_mirrors = {}
+        for archive_format in [ 'zip', 'tar.zst' ]:
+            stale_mirrors[archive_format] = os.path.join(self._tmp_dir.name, 'stale_' + archive_format).replace('\\', '/')
+            self.assertEqual(self._upload('10', '--archive_format', archive_format,
+                                          '--free-parameters', 'artifact_repository_destination=' + stale_mirrors[archive_format]), 0)
+
+        # Sources are tried in the order they are listed
+        with unittest.mock.patch('nimp.commands.download_fileset.DownloadFileset._probe', return_value = 0):
+            with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+                self.assertEqual(self._download('--force', '--source', stale_mirrors['tar.zst'], '--source', repository_url,
+                                                '--free-parameters', 'game=Game'), 0)
+                self.assertEqual(self._read('bin/readme.txt'), 'hello')
+                for archive_format in [ 'zip', 'tar.zst' ]:
+                    with nimp.tests.utils.serve_directory(stale_mirrors[archive_format]) as stale_mirror_url:
+                        self._write('bin/readme.txt', 'modified')
+                        self.assertEqual(self._download('--force', '--stream', '--source', stale_mirror_url, '--source', repository_url,
+                                                        '--free-parameters', 'game=Game'), 0)
+                        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+
+    def test_download_missing_mirror(self):
+        ''' Sources which are offline or lack the revision should be skipped,
+            unless no source is left. '''
+        self.assertEqual(self._upload('10'), 0)
+        empty_mirror = os.path.join(self._tmp_dir.name, 'empty_mirror').replace('\\', '/')
+        os.makedirs(empty_mirror)
+        with nimp.tests.utils.serve_directory(self.repository) as offline_url:
+            pass
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download('--source', empty_mirror, '--source', offline_url, '--source', self.repository), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+        self.assertNotEqual(self._download('--force', '--source', empty_mirror, '--source', offline_url), 0)
+
+    def test_download_deployed(self):
+        ''' Downloading a revision already deployed should do nothing, unless
+            its files were modified since. '''
+        self.assertEqual(self._upload('10'), 0)
+        self.assertEqual(self._download('-r', '10'), 0)
+        shutil.move(self.repository, self.repository + '_moved')
+        self.assertEqual(self._download('-r', '10'), 0)
+
+        shutil.move(self.repository + '_moved', self.repository)
+        self._write('bin/readme.txt', 'modified')
+        self.assertEqual(self._download('-r', '10'), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+
+    def test_download_delta(self):
+        ''' Uploads should publish deltas against the previous revision, and
+            downloads should apply them to the deployed revision. '''
+        self._write('bin/data.txt', 'data' * 16384)
+        self.assertEqual(self._upload('10'), 0)
+        self.assertEqual(self._download(), 0)
+        deployed = os.path.join(self._tmp_dir.name, 'deployed')
+        shutil.copytree(os.path.join(self.workspace, 'bin'), deployed)
+
+        self._write('bin/readme.txt', 'hello again')
+        self.assertEqual(self._upload('11', '--delta'), 0)
+        os.remove(os.path.join(self.workspace, 'bin/tools/run.sh'))
+        self._write('bin/new.txt', 'new')
+        self.assertEqual(self._upload('12', '--delta'), 0)
+        with open(self.repository + '/binaries/bin-linux-12.zip.delta-11.zip.manifest.json') as manifest_file:
+            delta_manifest = json.load(manifest_file)
+        self.assertEqual([ entry['name'] for entry in delta_manifest['entries'] ], [ 'bin/new.txt' ])
+        self.assertEqual(delta_manifest['removed'], [ 'bin/tools/run.sh' ])
+
+        # Full archives are made unusable, so only deltas can succeed
+        for revision in [ '11', '12' ]:
+            open(self.repository + '/binaries/bin-linux-%s.zip' % revision, 'wb').close()
+        shutil.rmtree(os.path.join(self.workspace, 'bin'))
+        shutil.copytree(deployed, os.path.join(self.workspace, 'bin'))
+        self.assertEqual(self._download('--prune'), 0)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello again')
+        self.assertEqual(self._read('bin/new.txt'), 'new')
+        self.assertFalse(os.path.exists(os.path.join(self.workspace, 'bin/tools/run.sh')))
+
+    @unittest.skipIf(nimp.system.try_import('zstandard') is None, 'zstandard python module is not installed')
+    def test_download_tar_zst(self):
+        ''' Filesets uploaded as tar.zst archives should be downloaded back,
+            locally or over HTTP, with their modes and modification times. '''
+        readme_path = os.path.join(self.workspace, 'bin/readme.txt')
+        os.utime(readme_path, ns = (1500000000123456789, 1500000000123456789))
+        self.assertEqual(self._upload('10', '--archive_format', 'tar.zst'), 0)
+        self.assertTrue(os.path.isfile(self.repository + '/binaries/bin-linux-10.tar.zst'))
+
+        cache_directory = os.path.join(self._tmp_dir.name, 'cache')
+        for is_http, parameters in [ (False, []), (True, []), (True, [ '--stream' ]), (True, [ 'artifact_cache_directory=' + cache_directory ]) ]:
+            shutil.rmtree(os.path.join(self.workspace, 'bin'))
+            if not is_http:
+                self.assertEqual(self._download(*parameters), 0)
+            else:
+                with nimp.tests.utils.serve_directory(self.repository) as repository_url:
+                    parameters = [ '--source', repository_url, '--free-parameters', 'game=Game' ] + parameters
+                    self.assertEqual(self._download(*parameters), 0)
+            self.assertEqual(self._read('bin/readme.txt'), 'hello')
+            self.assertEqual(os.stat(readme_path).st_mtime_ns, 1500000000123456789)
+            self.assertTrue(os.access(os.path.join(self.workspace, 'bin/tools/run.sh'), os.X_OK))
+
+        # Files already up to date are left untouched
+        os.utime(readme_path, (5, 5))
+        self._write('bin/tools/run.sh', 'modified')
+        self.assertEqual(self._download(), 0)
+        self.assertEqual(os.stat(readme_path).st_mtime, 5)
+        self.assertEqual(self._read('bin/tools/run.sh'), '#!/bin/sh\necho hello\n')
+
+        # Archives not matching their hash are not extracted at all
+        self._write('bin/tools/run.sh', 'modified')
+        nimp.artifacts.write_archive_hash(self.repository + '/binaries/bin-linux-10.tar.zst', '0' * 64)
+        self.assertNotEqual(self._download('--force'), 0)
+        self.assertEqual(self._read('bin/tools/run.sh'), 'modified')
+
+    def test_upload_http(self):
+        ''' Archives should be streamed to HTTP servers while they are
+            created, and published with their manifest and hash. '''
+        os.makedirs(self.repository)
+        nimp.tests.utils.WebDavRequestHandler.chunked_uploads = 0
+        with nimp.tests.utils.serve_directory(self.repository, nimp.tests.utils.WebDavRequestHandler) as repository_url:
+            parameters = [ '--free-parameters', 'artifact_repository_destination=' + repository_url,
+                           'artifact_repository_source=' + repository_url, 'game=Game' ]
+            self.assertEqual(self._upload('10', '--compress', *parameters), 0)
+            shutil.rmtree(os.path.join(self.workspace, 'bin'))
+            self.assertEqual(self._download(*parameters), 0)
+        self.assertEqual(nimp.tests.utils.WebDavRequestHandler.chunked_uploads, 1)
+        self.assertEqual(self._read('bin/readme.txt'), 'hello')
+        self.assertTrue(os.access(os.path.join(self.workspace, 'bin/tools/run.sh'), os.X_OK))
+
+        archive_path = self.repository + '/binaries/bin-linux-10.zip'
+        with open(archive_path, 'rb') as archive_file:
+            self.assertEqual(nimp.artifacts.load_archive_hash(archive_path, False), hashlib.sha256(archive_file.read()).hexdigest())
+        self.assertEqual(nimp.artifacts.load_manifest(archive_path, False)['archive_size'], os.path.getsize(archive_path))
+
+    def test_upload_http_failure(self):
+        ''' Uploads should fail cleanly when servers reject them, whether
+            they reject the archive or its manifest. '''
+        os.makedirs(self.repository + '/binaries')
+        for request_handler in [ http.server.SimpleHTTPRequestHandler, _ManifestRejectingRequestHandler ]:
+            with nimp.tests.utils.serve_directory(self.repository, request_handler) as repository_url:
+                self.assertNotEqual(self._upload('10', '--free-parameters', 'artifact_repository_destination=' + repository_url), 0)
+            # Archives are never published without their manifest
+            self.assertFalse(os.path.exists(self.repository + '/binaries/bin-linux-10.zip'))
+            self.assertFalse(os.path.exists(self.repository + '/binaries/bin-linux-10.zip.tmp'))
+
+    def test_upload_manifest_failure(self):
+        ''' Archives should not be moved into place when their manifest
+            cannot be written. '''
+        with unittest.mock.patch('nimp.artifacts.write_manifest', side_effect = OSError('disk full')):
+            with self.assertRaises(OSError):
+                self._upload('10')
+        self.assertTrue(os.path.exists(self.repository + '/binaries/bin-linux-10.zip.sha256'))
+        self.assertFalse(os.path.exists(self.repository + '/binaries/bin-linux-10.zip'))
+        self.assertFalse(os.path.exists(self.repository + '/binaries/bin-linux-10.zip.tmp'))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' HTTP utilities unit tests '''
+
+import hashlib
+import http.server
+import os
+import tempfile
+import time
+import types
+import unittest
+import unittest.mock
+import zipfile
+
+import nimp.system
+import nimp.tests.utils
+import nimp.utils.http
+
+class _ListingTests(unittest.TestCase):
+    def test_fetch_listing(self):
+        ''' Unmodified listings should neither be downloaded nor parsed again. '''
+        parsed_listings = []
+        def _parse(content):
+            parsed_listings.append(content)
+            return content.split()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'listing.html'), 'w') as listing_file:
+                listing_file.write('foo bar')
+            cache_directory = os.path.join(tmp_dir, 'cache')
+            with nimp.tests.utils.serve_directory(tmp_dir) as base_url:
+                for _ in range(3):
+                    result = nimp.utils.http.fetch_listing(base_url + '/listing.html', cache_directory, _parse, 'split')
+                    self.assertEqual(result, [ 'foo', 'bar' ])
+        self.assertEqual(len(parsed_listings), 1)
+
+    def test_list_all_revisions(self):
+        ''' Revisions should be parsed from the anchors of a listing, keeping
+            only the ones matching requested values, and not their deltas. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in [ 'bin-win64-devel-9.zip', 'bin-win64-devel-10.zip', 'bin-linux-devel-10.zip', 'bin-win64-devel-x.zip',
+                          'bin-win64-devel-11.zip.delta-10.zip' ]:
+                with open(os.path.join(tmp_dir, name), 'w'):
+                    pass
+            env = types.SimpleNamespace(root_dir = tmp_dir, revision = None, platform = 'win64', configuration = None, dlc = None)
+            with nimp.tests.utils.serve_directory(tmp_dir) as base_url:
+                archive_format = base_url + '/bin-{platform}-{configuration}-{revision}.zip'
+                revisions_info = nimp.system.list_all_revisions(env, archive_format)
+        self.assertEqual(sorted(info['revision'] for info in revisions_info), [ '10', '9' ])
+        self.assertEqual(revisions_info[0]['location'], base_url + '/bin-win64-devel-' + revisions_info[0]['revision'] + '.zip')
+
+    def test_list_archive_formats(self):
+        ''' Zip archives should be preferred for a same revision, even if
+            listed after archives of other formats. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in [ 'bin-win64-9.zip', 'bin-win64-10.tar.zst', 'bin-win64-10.zip', 'bin-win64-11.tar.zst' ]:
+                with open(os.path.join(tmp_dir, name), 'w'):
+                    pass
+            env = types.SimpleNamespace(root_dir = tmp_dir, revision = None, platform = 'win64', configuration = None, dlc = None)
+            with nimp.tests.utils.serve_directory(tmp_dir) as base_url:
+                revisions_info = nimp.system.list_all_revisions(env, base_url + '/bin-{platform}-{revision}.zip')
+        self.assertEqual([ info['location'].rpartition('/')[2] for info in revisions_info ],
+                         [ 'bin-win64-11.tar.zst', 'bin-win64-10.zip', 'bin-win64-10.tar.zst', 'bin-win64-9.zip' ])
+
+class _RangeFileTests(unittest.TestCase):
+    def test_remote_zip(self):
+        ''' Reading an entry from a remote archive should only transfer its
+            central directory and that entry. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, 'archive.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive_file:
+                archive_file.writestr('large.bin', os.urandom(1024 * 1024))
+                archive_file.writestr('small.txt', 'hello')
+            nimp.tests.utils.RangeRequestHandler.sent_bytes = 0
+            with nimp.tests.utils.serve_directory(tmp_dir, nimp.tests.utils.RangeRequestHandler) as base_url:
+                remote_file = nimp.utils.http.RangeFile(base_url + '/archive.zip', block_size = 16 * 1024, read_ahead = 2)
+                with zipfile.ZipFile(remote_file) as remote_archive:
+                    self.assertEqual(remote_archive.namelist(), [ 'large.bin', 'small.txt' ])
+                    self.assertEqual(remote_archive.read('small.txt'), b'hello')
+        self.assertLess(nimp.tests.utils.RangeRequestHandler.sent_bytes, 128 * 1024)
+
+    def test_range_not_supported(self):
+        ''' Servers ignoring range requests should be reported. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'archive.zip'), 'wb') as archive_file:
+                archive_file.write(b'content')
+            with nimp.tests.utils.serve_directory(tmp_dir) as base_url:
+                with self.assertRaises(nimp.utils.http.RangeNotSupportedError):
+                    nimp.utils.http.RangeFile(base_url + '/archive.zip')
+
+class _FlakyRequestHandler(nimp.tests.utils.RangeRequestHandler):
+    ''' Closes the connection halfway through the first large response '''
+    failures = 1
+
+    def copyfile(self, source, outputfile):
+        content = source.read()
+        if len(content) > 1 and _FlakyRequestHandler.failures > 0:
+            _FlakyRequestHandler.failures -= 1
+            content = content[:len(content) // 2]
+            self.close_connection = True
+        outputfile.write(content)
+
+class _CorruptingRequestHandler(nimp.tests.utils.RangeRequestHandler):
+    ''' Corrupts the first large response '''
+    corruptions = 1
+
+    def copyfile(self, source, outputfile):
+        content = source.read()
+        if len(content) > 1 and _CorruptingRequestHandler.corruptions > 0:
+            _CorruptingRequestHandler.corruptions -= 1
+            content = bytes([ content[0] ^ 0xFF ]) + content[1:]
+        outputfile.write(content)
+
+class _StallingRequestHandler(nimp.tests.utils.RangeRequestHandler):
+    ''' Stops sending halfway through the first large response '''
+    stalls = 1
+
+    def copyfile(self, source, outputfile):
+        content = source.read()
+        if len(content) > 1 and _StallingRequestHandler.stalls > 0:
+            _StallingRequestHandler.stalls -= 1
+            outputfile.write(content[:len(content) // 2])
+            outputfile.flush()
+            time.sleep(5)
+            self.close_connection = True
+            return
+        outputfile.write(content)
+
+class _DownloadTests(unittest.TestCase):
+    def _download(self, handler_class, **kwargs):
+        content = os.urandom(256 * 1024)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'archive.zip'), 'wb') as archive_file:
+                archive_file.write(content)
+            destination = os.path.join(tmp_dir, 'downloaded.zip')
+            with nimp.tests.utils.serve_directory(tmp_dir, handler_class) as base_url:
+                download = nimp.utils.http.Download(base_url + '/archive.zip')
+                download.run(destination, min_segment_size = 32 * 1024, **kwargs)
+            with open(destination, 'rb') as downloaded_file:
+                self.assertEqual(downloaded_file.read(), content)
+        return download
+
+    def test_segmented_download(self):
+        ''' Servers supporting range requests should be downloaded from in
+            concurrent segments. '''
+        self.assertTrue(self._download(nimp.tests.utils.RangeRequestHandler, segment_count = 4).supports_ranges)
+
+    def test_single_stream_download(self):
+        ''' Servers not supporting range requests should be downloaded from
+            in a single stream. '''
+        self.assertFalse(self._download(http.server.SimpleHTTPRequestHandler, segment_count = 4).supports_ranges)
+
+    def test_download_retry(self):
+        ''' Interrupted segments should be resumed. '''
+        _FlakyRequestHandler.failures = 1
+        self._download(_FlakyRequestHandler, segment_count = 4, retries = 1)
+        self.assertEqual(_FlakyRequestHandler.failures, 0)
+
+    def test_download_stall(self):
+        ''' Stalled segments should time out and be resumed. '''
+        _StallingRequestHandler.stalls = 1
+        start_time = time.monotonic()
+        with unittest.mock.patch('nimp.utils.http.TIMEOUT', (1, 0.5)):
+            self._download(_StallingRequestHandler, segment_count = 4, retries = 1)
+        self.assertEqual(_StallingRequestHandler.stalls, 0)
+        self.assertLess(time.monotonic() - start_time, 4)
+
+    def test_download_hash(self):
+        ''' Downloads not matching their hash should be downloaded again. '''
+        content = os.urandom(256 * 1024)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'archive.zip'), 'wb') as archive_file:
+                archive_file.write(content)
+            destination = os.path.join(tmp_dir, 'downloaded.zip')
+            _CorruptingRequestHandler.corruptions = 1
+            with nimp.tests.utils.serve_directory(tmp_dir, _CorruptingRequestHandler) as base_url:
+                download = nimp.utils.http.Download(base_url + '/archive.zip')
+                download.run(destination, segment_count = 4, min_segment_size = 32 * 1024, sha256 = hashlib.sha256(content).hexdigest())
+                with open(destination, 'rb') as downloaded_file:
+                    self.assertEqual(downloaded_file.read(), content)
+                self.assertEqual(_CorruptingRequestHandler.corruptions, 0)
+                with self.assertRaises(nimp.utils.http.DownloadError):
+                    download.run(destination, sha256 = hashlib.sha256(b'other').hexdigest())
+
+    def test_download_resume(self):
+        ''' Interrupted downloads should be resumed by the next run. '''
+        content = os.urandom(256 * 1024)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'archive.zip'), 'wb') as archive_file:
+                archive_file.write(content)
+            destination = os.path.join(tmp_dir, 'downloaded.zip')
+            _FlakyRequestHandler.failures = 1
+            with nimp.tests.utils.serve_directory(tmp_dir, _FlakyRequestHandler) as base_url:
+                with self.assertRaises(Exception):
+                    nimp.utils.http.Download(base_url + '/archive.zip').run(destination, retries = 0)
+
+            nimp.tests.utils.RangeRequestHandler.sent_bytes = 0
+            with nimp.tests.utils.serve_directory(tmp_dir, nimp.tests.utils.RangeRequestHandler) as base_url:
+                nimp.utils.http.Download(base_url + '/archive.zip').run(destination)
+            with open(destination, 'rb') as downloaded_file:
+                self.assertEqual(downloaded_file.read(), content)
+            self.assertLess(nimp.tests.utils.RangeRequestHandler.sent_bytes, len(content))
+            nimp.utils.http.Download.remove(destination)
+            self.assertEqual(os.listdir(tmp_dir), [ 'archive.zip' ])
+
+class _UploadStreamTests(unittest.TestCase):
+    def test_upload_stream(self):
+        ''' Data written to an upload stream should be sent as it is written,
+            and not be published if writing it fails. '''
+        content = os.urandom(3 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            nimp.tests.utils.WebDavRequestHandler.chunked_uploads = 0
+            with nimp.tests.utils.serve_directory(tmp_dir, nimp.tests.utils.WebDavRequestHandler) as base_url:
+                nimp.utils.http.make_collections(base_url + '/a/b/uploaded.bin')
+                with nimp.utils.http.UploadStream(base_url + '/a/b/uploaded.bin') as upload_stream:
+                    for offset in range(0, len(content), 100000):
+                        upload_stream.write(content[offset:offset + 100000])
+                self.assertEqual(upload_stream.size, len(content))
+                self.assertEqual(upload_stream.sha256.hexdigest(), hashlib.sha256(content).hexdigest())
+
+                with self.assertRaises(RuntimeError):
+                    with nimp.utils.http.UploadStream(base_url + '/a/b/aborted.bin') as upload_stream:
+                        upload_stream.write(content)
+                        raise RuntimeError('Archive creation has failed')
+            with open(os.path.join(tmp_dir, 'a', 'b', 'uploaded.bin'), 'rb') as uploaded_file:
+                self.assertEqual(uploaded_file.read(), content)
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'a', 'b', 'aborted.bin')))
+        self.assertGreaterEqual(nimp.tests.utils.WebDavRequestHandler.chunked_uploads, 1)
@@ -23,6 +23,7 @@
 
 import os
 import itertools
+import tempfile
 import unittest
 
 import nimp.tests.utils
@@ -149,3 +150,73 @@ class _FileSetTests(unittest.TestCase):
         files, src = _file_mapper()
         src.src('foo').to('dest').glob('quux.ext1')
         self._check_files(files(), ('foo/quux.ext1', 'dest/quux.ext1'))
+
+def _write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as output:
+        output.write(content)
+
+def _read_file(path):
+    with open(path) as source:
+        return source.read()
+
+class _MirrorTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self._tmp_dir.name, 'src')
+        self.dest = os.path.join(self._tmp_dir.name, 'dest')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _fileset(self):
+        mapper = nimp.system.FileMapper(mapper=_yield_mapper)
+        mapper.src(self.src).to(self.dest).glob('**')
+        return mapper()
+
+    def test_mirror(self):
+        ''' Mirror should copy changed files, keep unchanged ones and drop
+            extraneous ones. '''
+        _write_file(os.path.join(self.src, 'same.txt'), 'same')
+        _write_file(os.path.join(self.src, 'sub', 'new.txt'), 'new')
+        self.assertTrue(nimp.system.mirror(self._fileset(), self.dest))
+        same_inode = os.stat(os.path.join(self.dest, 'same.txt')).st_ino
+
+        _write_file(os.path.join(self.dest, 'stale.txt'), 'stale')
+        _write_file(os.path.join(self.src, 'sub', 'new.txt'), 'changed')
+        os.utime(os.path.join(self.src, 'sub', 'new.txt'), (0, 2 ** 31))
+        self.assertTrue(nimp.system.mirror(self._fileset(), self.dest))
+
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'stale.txt')))
+        self.assertEqual(_read_file(os.path.join(self.dest, 'sub', 'new.txt')), 'changed')
+        self.assertEqual(os.stat(os.path.join(self.dest, 'same.txt')).st_ino, same_inode)
+        self.assertFalse(os.path.exists(self.dest + '.mirror'))
+        self.assertFalse(os.path.exists(self.dest + '.old'))
+
+    def test_mirror_newer_destination(self):
+        ''' Destination files newer than their source should be replaced,
+            as when packaging an older build. '''
+        _write_file(os.path.join(self.src, 'file.txt'), 'NEW1')
+        os.utime(os.path.join(self.src, 'file.txt'), (1000, 1000))
+        _write_file(os.path.join(self.dest, 'file.txt'), 'OLD1')
+        self.assertTrue(nimp.system.mirror(self._fileset(), self.dest))
+        self.assertEqual(_read_file(os.path.join(self.dest, 'file.txt')), 'NEW1')
+
+class _CopyPlanTests(unittest.TestCase):
+    def test_plan_copy(self):
+        ''' Copy plan should count up to date files as skipped and deduct
+            overwritten files from the required space. '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, 'src')
+            dest = os.path.join(tmp_dir, 'dest')
+            _write_file(os.path.join(src, 'same.txt'), 'same')
+            _write_file(os.path.join(src, 'bigger.txt'), 'bigger')
+            _write_file(os.path.join(dest, 'bigger.txt'), 'big')
+            nimp.system.robocopy(os.path.join(src, 'same.txt'), os.path.join(dest, 'same.txt'))
+            fileset = [(os.path.join(src, name), os.path.join(dest, name)) for name in [ 'same.txt', 'bigger.txt' ]]
+
+            plan = nimp.system.plan_copy(fileset, skip_up_to_date = True)
+            self.assertEqual((plan.file_count, plan.total_bytes, plan.skipped_bytes, plan.required_bytes), (2, 10, 4, 3))
+
+            plan = nimp.system.plan_copy(fileset, in_place = False)
+            self.assertEqual((plan.skipped_bytes, plan.required_bytes), (0, 10))
@@ -23,8 +23,14 @@
 
 import abc
 import contextlib
+import functools
+import http.server
+import io
 import os.path
+import re
+import threading
 import unittest.mock
+import urllib.parse
 
 import pyfakefs.fake_filesystem_unittest
 
@@ -74,8 +80,10 @@ def mock_filesystem():
     ''' Sets up a mock filesystem '''
     patcher = pyfakefs.fake_filesystem_unittest.Patcher()
     patcher.setUp()
-    yield patcher.fs
-    patcher.tearDown()
+    try:
+        yield patcher.fs
+    finally:
+        patcher.tearDown()
 
 def create_file( name, content):
     ''' Creates a file on the fake file system '''
@@ -90,3 +98,139 @@ def dry_run_mock():
     with mock_capture_process_output():
         with mock_call_process():
             yield
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    ''' Request handler also serving single byte ranges, and counting the
+        bytes it sent '''
+    sent_bytes = 0
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        range_match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if range_match is None or not os.path.isfile(path):
+            return super(RangeRequestHandler, self).send_head()
+
+        size = os.path.getsize(path)
+        if range_match.group(1):
+            start = int(range_match.group(1))
+            end = min(size - 1, int(range_match.group(2))) if range_match.group(2) else size - 1
+        else:
+            start = max(0, size - int(range_match.group(2)))
+            end = size - 1
+        if start > end:
+            self.send_error(416)
+            return None
+
+        with open(path, 'rb') as served_file:
+            served_file.seek(start)
+            content = served_file.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        return io.BytesIO(content)
+
+    def copyfile(self, source, outputfile):
+        content = source.read()
+        RangeRequestHandler.sent_bytes += len(content)
+        outputfile.write(content)
+
+class WebDavRequestHandler(http.server.SimpleHTTPRequestHandler):
+    ''' Request handler also accepting PUT, MOVE, DELETE and MKCOL
+        requests, like a WebDAV server. Uploaded files are only published
+        once fully received, and uploads sent with chunked transfer encoding
+        are counted. '''
+    chunked_uploads = 0
+
+    def do_PUT(self): #pylint: disable=invalid-name
+        ''' Stores the request body '''
+        path = self.translate_path(self.path)
+        if not os.path.isdir(os.path.dirname(path)):
+            self.send_error(409)
+            return
+        upload_path = path + '.upload'
+        try:
+            with open(upload_path, 'wb') as upload_file:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    WebDavRequestHandler.chunked_uploads += 1
+                    self._read_chunks(upload_file)
+                else:
+                    upload_file.write(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            os.replace(upload_path, path)
+        except (OSError, ValueError):
+            # Interrupted uploads are dropped
+            os.remove(upload_path)
+            self.close_connection = True
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_MOVE(self): #pylint: disable=invalid-name
+        ''' Moves a file to the URL of the Destination header '''
+        path = self.translate_path(self.path)
+        destination_path = self.translate_path(urllib.parse.urlsplit(self.headers.get('Destination', '')).path)
+        try:
+            os.replace(path, destination_path)
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_DELETE(self): #pylint: disable=invalid-name
+        ''' Deletes a file '''
+        try:
+            os.remove(self.translate_path(self.path))
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def do_MKCOL(self): #pylint: disable=invalid-name
+        ''' Creates a directory '''
+        path = self.translate_path(self.path)
+        if os.path.exists(path):
+            self.send_error(405)
+            return
+        try:
+            os.mkdir(path)
+        except OSError:
+            self.send_error(409)
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _read_chunks(self, output):
+        while True:
+            size_line = self.rfile.readline()
+            if not size_line:
+                raise ValueError('Connection closed before the last chunk')
+            size = int(size_line.split(b';')[0], 16)
+            if size == 0:
+                while self.rfile.readline() not in [ b'\r\n', b'\n', b'' ]:
+                    pass
+                return
+            chunk = self.rfile.read(size)
+            if len(chunk) < size:
+                raise ValueError('Connection closed within a chunk')
+            output.write(chunk)
+            self.rfile.readline()
+
+@contextlib.contextmanager
+def serve_directory(directory, handler_class = http.server.SimpleHTTPRequestHandler):
+    ''' Serves a directory over HTTP on localhost, yielding its base url '''
+    handler = functools.partial(handler_class, directory = directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server_thread = threading.Thread(target = server.serve_forever, daemon = True)
+    server_thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -23,6 +23,8 @@
 ''' Utility functions '''
 
 __all__ = [
+    'archive',
+    'http',
     'p4',
     'torrent',
 ]
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Archive related utilities '''
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+import nimp.system
+
+_CHUNK_SIZE = 1024 * 1024
+_SPOOL_SIZE = 64 * 1024 * 1024
+
+_LOCAL_FILE_SIGNATURE = b'PK\x03\x04'
+_LOCAL_FILE_HEADER = struct.Struct('<HHHHHIIIHH')
+_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+_DATA_DESCRIPTOR = struct.Struct('<III')
+_ZIP64_DATA_DESCRIPTOR = struct.Struct('<IQQ')
+_DEFLATE_WINDOW_SIZE = 32 * 1024
+_CENTRAL_DIRECTORY_SIGNATURES = [ b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07' ]
+_EXTRA_FIELD_HEADER = struct.Struct('<HH')
+_ZIP64_EXTRA_ID = 0x0001
+_ZIP64_LIMIT = 0xFFFFFFFF
+_NTFS_EXTRA_ID = 0x000a
+_NTFS_TIMES_TAG = 0x0001
+_NTFS_TIMES = struct.Struct('<IHHQQQ')
+_NTFS_EPOCH_OFFSET = 116444736000000000 # 100ns intervals from 1601 to 1970
+_UNIX_TIME_EXTRA_ID = 0x5455
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+class StreamingNotSupportedError(Exception):
+    ''' Raised when an archive can only be extracted using its central
+        directory, i.e. once it is fully available '''
+
+def stream_extract(stream, destination, handle_zip_of_zips = False, entry_filter = None, read_entries = None):
+    ''' Extracts a zip archive from a non seekable stream while it is being
+        read, decoding local file headers instead of the central directory.
+        Yields the path of every extracted file. Nested archives are
+        extracted on the fly when handle_zip_of_zips is set and every entry
+        is a zip archive. When given, entry_filter is called with every
+        entry name and entries it rejects are skipped, and read_entries is a
+        dictionary filled with the size and CRC of every entry once read,
+        skipped ones included, but not entries of nested archives.
+        StreamingNotSupportedError is raised for archives that need their
+        central directory (encrypted entries, stored entries of unknown
+        size…), callers should then fall back to a regular extraction. '''
+    reader = _StreamReader(stream)
+    go_deeper = None
+    while True:
+        signature = reader.read_signature()
+        if signature is None or signature in _CENTRAL_DIRECTORY_SIGNATURES:
+            break
+        if signature != _LOCAL_FILE_SIGNATURE:
+            raise zipfile.BadZipFile('Bad local file header signature')
+
+        entry = _EntryReader(reader)
+        is_zip = entry.name.endswith('.zip')
+        if go_deeper is None:
+            go_deeper = handle_zip_of_zips and is_zip
+        elif go_deeper and not is_zip:
+            raise StreamingNotSupportedError('archive mixes nested archives and files')
+
+        if go_deeper:
+            for filename in stream_extract(entry, destination, entry_filter = entry_filter):
+                yield filename
+        elif entry_filter is None or entry_filter(entry.name):
+            filename = _extract_entry(entry, destination)
+            if filename is not None:
+                yield filename
+        entry.finish()
+        if read_entries is not None:
+            read_entries[entry.name] = (entry.size, entry.crc)
+
+    # Consume the central directory too, so the stream can be reused
+    while reader.read(_CHUNK_SIZE):
+        pass
+
+class FileView(io.RawIOBase):
+    ''' Seekable read-only view of a part of a file. Every view keeps its
+        own position, and views of a same file share a lock serializing
+        accesses to it, so that several views can be read concurrently, e.g.
+        by ZipFile instances in different threads. Views of a view read the
+        underlying file directly. '''
+    def __init__(self, file, offset = 0, size = None, lock = None):
+        super(FileView, self).__init__()
+        if isinstance(file, FileView):
+            offset += file.offset
+            lock = file.lock
+            size = size if size is not None else file.size - (offset - file.offset)
+            file = file.file
+        self.file = file
+        self.offset = offset
+        self.lock = lock if lock is not None else threading.Lock()
+        if size is None:
+            with self.lock:
+                size = file.seek(0, io.SEEK_END) - offset
+        self.size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), self.size - self._position))
+        if size == 0:
+            return 0
+        with self.lock:
+            self.file.seek(self.offset + self._position)
+            data = self.file.read(size)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+def open_member(zip_file, info):
+    ''' Opens a member of an archive as a seekable file without loading it
+        in memory, e.g. to open a nested archive. Stored members are read in
+        place through a view of the archive file, other members are inflated
+        to a spooled temporary file. The archive should itself be read
+        through a FileView. '''
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & _FLAG_ENCRYPTED:
+        header = FileView(zip_file.fp, info.header_offset, len(_LOCAL_FILE_SIGNATURE) + _LOCAL_FILE_HEADER.size)
+        header_data = header.read()
+        if header_data[:len(_LOCAL_FILE_SIGNATURE)] != _LOCAL_FILE_SIGNATURE:
+            raise zipfile.BadZipFile('Bad local file header signature for %s' % info.filename)
+        fields = _LOCAL_FILE_HEADER.unpack(header_data[len(_LOCAL_FILE_SIGNATURE):])
+        data_offset = info.header_offset + len(header_data) + fields[8] + fields[9]
+        return FileView(zip_file.fp, data_offset, info.file_size)
+
+    member_file = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE)
+    with zip_file.open(info) as member:
+        shutil.copyfileobj(member, member_file, _CHUNK_SIZE)
+    member_file.seek(0)
+    return member_file
+
+class ParallelZipWriter(object):
+    ''' Adds files to a zip archive being written, deflating them on several
+        threads. Files are cut in chunks deflated independently, each one
+        primed with the end of the previous one so the compression ratio
+        barely suffers, like pigz does. Compressed chunks are written in
+        order from the calling thread, so the result is a standard zip
+        archive. Archives written to unseekable streams get data descriptors
+        instead of having their local headers updated. '''
+    # Entries are written as ZipFile.open(mode='w') does, relying on the
+    # same CPython zipfile internals: ZipFile.fp, filelist, NameToInfo,
+    # start_dir, _lock and _writing, and ZipInfo.FileHeader. The archive
+    # lock is held and _writing set while an entry is being written, so the
+    # zip file cannot be written to or closed in the meantime.
+    def __init__(self, zip_file, worker_count = None, level = zlib.Z_DEFAULT_COMPRESSION, chunk_size = _CHUNK_SIZE):
+        self.zip_file = zip_file
+        self.level = level
+        self.chunk_size = chunk_size
+        worker_count = worker_count or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = worker_count)
+        # Bounds how much data is waiting to be written
+        self._max_pending = 4 * worker_count
+        self._pending = collections.deque()
+        self._seekable = getattr(zip_file.fp, 'seekable', lambda: False)()
+        self._entry = None
+        self._is_writing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, filename, info):
+        ''' Adds a file as an entry described by the given ZipInfo, stored or
+            deflated according to its compress_type. Returns the SHA-256 hash
+            of the file, computed while reading it. '''
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError('Unsupported compression method %d' % info.compress_type)
+        file_hash = hashlib.sha256()
+        crc = 0
+        size = 0
+        self._queue(('header', info))
+        with open(filename, 'rb') as input_file:
+            data = input_file.read(self.chunk_size)
+            dictionary = b''
+            while True:
+                next_data = input_file.read(self.chunk_size)
+                file_hash.update(data)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                if info.compress_type == zipfile.ZIP_DEFLATED:
+                    self._queue(('data', self._executor.submit(_deflate_chunk, data, dictionary, not next_data, self.level)))
+                    dictionary = data[-_DEFLATE_WINDOW_SIZE:]
+                else:
+                    self._queue(('data', data))
+                if not next_data:
+                    break
+                data = next_data
+        self._queue(('end', (crc & 0xFFFFFFFF, size)))
+        return file_hash.hexdigest()
+
+    def flush(self):
+        ''' Writes every entry added so far to the archive '''
+        while self._pending:
+            self._write(self._pending.popleft())
+
+    def close(self):
+        ''' Writes every pending entry, then stops worker threads. The zip
+            file itself is left open. '''
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+            if self._is_writing:
+                self._end_entry()
+
+    def _queue(self, item):
+        self._pending.append(item)
+        while len(self._pending) > self._max_pending:
+            self._write(self._pending.popleft())
+
+    def _write(self, item):
+        output = self.zip_file.fp
+        kind, value = item
+        if kind == 'header':
+            # Sizes and CRC are written once known, same zip64 rule as
+            # ZipFile.open since the final size is not known yet
+            self._begin_entry(value)
+            value.header_offset = output.tell()
+            value.flag_bits = 0 if self._seekable else _FLAG_DATA_DESCRIPTOR
+            value.CRC = value.compress_size = 0
+            zip64 = value.file_size * 1.05 > zipfile.ZIP64_LIMIT
+            output.write(value.FileHeader(zip64))
+            self._entry = (value, zip64, output.tell())
+        elif kind == 'data':
+            output.write(value.result() if isinstance(value, concurrent.futures.Future) else value)
+        else:
+            info, zip64, data_offset = self._entry
+            info.CRC, info.file_size = value
+            info.compress_size = output.tell() - data_offset
+            if not zip64 and max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT:
+                raise RuntimeError('%s grew over the zip64 limit while being archived' % info.filename)
+            if self._seekable:
+                end_offset = output.tell()
+                output.seek(info.header_offset)
+                output.write(info.FileHeader(zip64))
+                output.seek(end_offset)
+            else:
+                descriptor = _ZIP64_DATA_DESCRIPTOR if zip64 else _DATA_DESCRIPTOR
+                output.write(_DATA_DESCRIPTOR_SIGNATURE + descriptor.pack(info.CRC, info.compress_size, info.file_size))
+            self.zip_file.filelist.append(info)
+            self.zip_file.NameToInfo[info.filename] = info
+            self.zip_file.start_dir = output.tell()
+            self._end_entry()
+
+    def _begin_entry(self, info):
+        self.zip_file._lock.acquire() #pylint: disable=protected-access
+        if self.zip_file._writing: #pylint: disable=protected-access
+            self.zip_file._lock.release() #pylint: disable=protected-access
+            raise ValueError('Cannot add %s while another entry is being written' % info.filename)
+        self.zip_file._writing = True #pylint: disable=protected-access
+        self._is_writing = True
+
+    def _end_entry(self):
+        self._entry = None
+        self._is_writing = False
+        self.zip_file._writing = False #pylint: disable=protected-access
+        self.zip_file._lock.release() #pylint: disable=protected-access
+
+def _deflate_chunk(data, dictionary, is_last, level):
+    # Raw deflate, as stored in zip entries. Chunks but the last one end
+    # with a sync flush, so their output can be concatenated.
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict = dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+def get_timestamp_extra(mtime_ns):
+    ''' Returns an NTFS extra field recording a modification time with a
+        100ns precision, where the entry date_time has a 2s precision and
+        depends on the time zone '''
+    file_time = mtime_ns // 100 + _NTFS_EPOCH_OFFSET
+    field = _NTFS_TIMES.pack(0, _NTFS_TIMES_TAG, 24, file_time, file_time, file_time)
+    return _EXTRA_FIELD_HEADER.pack(_NTFS_EXTRA_ID, len(field)) + field
+
+def get_entry_mtime(date_time, extra):
+    ''' Returns the modification time of an entry in nanoseconds, from its
+        NTFS or Unix extra timestamp when it has one, or else from its
+        date_time '''
+    for field_id, field in _iter_extra_fields(extra):
+        if field_id == _NTFS_EXTRA_ID and len(field) >= _NTFS_TIMES.size:
+            _, tag, size, mtime, _, _ = _NTFS_TIMES.unpack(field[:_NTFS_TIMES.size])
+            if tag == _NTFS_TIMES_TAG and size == 24:
+                return (mtime - _NTFS_EPOCH_OFFSET) * 100
+        elif field_id == _UNIX_TIME_EXTRA_ID and len(field) >= 5 and field[0] & 0x01:
+            return struct.unpack('<i', field[1:5])[0] * 1000000000
+    return int(time.mktime(tuple(date_time) + (0, 0, -1))) * 1000000000
+
+def restore_mtime(filename, date_time, extra):
+    ''' Gives an extracted file the modification time of its entry '''
+    mtime = get_entry_mtime(date_time, extra)
+    os.utime(filename, ns = (mtime, mtime))
+
+def _iter_extra_fields(extra):
+    while len(extra) >= _EXTRA_FIELD_HEADER.size:
+        field_id, field_size = _EXTRA_FIELD_HEADER.unpack(extra[:_EXTRA_FIELD_HEADER.size])
+        yield field_id, extra[_EXTRA_FIELD_HEADER.size:_EXTRA_FIELD_HEADER.size + field_size]
+        extra = extra[_EXTRA_FIELD_HEADER.size + field_size:]
+
+def get_entropy(data):
+    ''' Returns the Shannon entropy of some data in bits per byte, close to
+        8 for data already compressed '''
+    if not data:
+        return 0.0
+    counts = collections.Counter(data)
+    return -sum(count * math.log2(count / len(data)) for count in counts.values()) / len(data)
+
+def set_tar_mtime(tar_info, mtime_ns):
+    ''' Records a modification time with a nanosecond precision in the pax
+        header of a tar member, whose mtime field has a 1s precision '''
+    tar_info.mtime = mtime_ns // 1000000000
+    tar_info.pax_headers['mtime'] = '%d.%09d' % divmod(mtime_ns, 1000000000)
+
+def get_tar_mtime(tar_info):
+    ''' Returns the modification time of a tar member in nanoseconds, from
+        its pax header when it has one, since tarfile parses it as a float '''
+    pax_mtime = tar_info.pax_headers.get('mtime')
+    if pax_mtime is not None:
+        seconds, _, fraction = pax_mtime.partition('.')
+        try:
+            return int(seconds) * 1000000000 + int((fraction + '000000000')[:9])
+        except ValueError:
+            pass
+    return int(tar_info.mtime) * 1000000000
+
+class HashingReader(io.RawIOBase):
+    ''' Reads a stream while computing the size, SHA-256 hash and CRC32 of
+        what was read '''
+    def __init__(self, stream):
+        super(HashingReader, self).__init__()
+        self.stream = stream
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.crc = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.size += len(data)
+        self.sha256.update(data)
+        self.crc = zlib.crc32(data, self.crc) & 0xFFFFFFFF
+        return len(data)
+
+def _extract_entry(entry, destination):
+    filename = get_target_path(destination, entry.name)
+    if entry.name.endswith('/'):
+        nimp.system.safe_makedirs(filename)
+        return None
+    nimp.system.safe_makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as target_file:
+        for chunk in iter(lambda: entry.read(_CHUNK_SIZE), b''):
+            target_file.write(chunk)
+    restore_mtime(filename, entry.date_time, entry.extra)
+    return filename
+
+def get_target_path(destination, name):
+    ''' Returns where an archive entry is extracted, using the same
+        sanitization as zipfile.ZipFile.extract '''
+    name = name.replace('/', os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    parts = [ part for part in name.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir) ]
+    return os.path.join(destination, *parts)
+
+class _StreamReader(object):
+    ''' Buffered reader over a stream, supporting pushing data back '''
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = bytearray()
+
+    def read(self, size):
+        ''' Reads up to size bytes, only returns nothing at end of stream '''
+        if self._buffer:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+        return self._stream.read(size)
+
+    def read_exact(self, size):
+        ''' Reads exactly size bytes '''
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise zipfile.BadZipFile('Unexpected end of archive')
+            data += chunk
+        return data
+
+    def read_signature(self):
+        ''' Reads a record signature, returns None at end of stream '''
+        data = self.read(4)
+        if not data:
+            return None
+        return data + self.read_exact(4 - len(data))
+
+    def unread(self, data):
+        ''' Pushes data back, to be read again '''
+        self._buffer[0:0] = data
+
+class _EntryReader(object):
+    ''' Reads the header of the archive entry at the current stream position
+        and provides a file-like object over its uncompressed data '''
+    def __init__(self, reader):
+        self._reader = reader
+        (_, self._flags, self._method, dos_time, dos_date, self._expected_crc, compress_size, file_size,
+         name_length, extra_length) = _LOCAL_FILE_HEADER.unpack(reader.read_exact(_LOCAL_FILE_HEADER.size))
+        name = reader.read_exact(name_length)
+        self.name = name.decode('utf-8' if self._flags & _FLAG_UTF8 else 'cp437')
+        # Same decoding as zipfile.ZipInfo.date_time
+        self.date_time = ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+                          dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2)
+        self.extra = reader.read_exact(extra_length)
+        self._is_zip64 = False
+        self._remaining = self._read_extra(self.extra, compress_size, file_size)
+
+        if self._flags & _FLAG_ENCRYPTED:
+            raise StreamingNotSupportedError('%s is encrypted' % self.name)
+        if self._method not in [ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]:
+            raise StreamingNotSupportedError('%s uses compression method %d' % (self.name, self._method))
+        if self._flags & _FLAG_DATA_DESCRIPTOR:
+            if self._method == zipfile.ZIP_STORED:
+                raise StreamingNotSupportedError('size of stored entry %s is unknown' % self.name)
+            # Sizes will only be known after the data, deflate tells where it ends
+            self._remaining = None
+
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if self._method == zipfile.ZIP_DEFLATED else None
+        self._input = b''
+        self._crc = 0
+        self._eof = self._remaining == 0 and self._decompressor is None
+        self.size = 0
+
+    @property
+    def crc(self):
+        ''' CRC of the uncompressed data read so far '''
+        return self._crc
+
+    def _read_extra(self, extra, compress_size, file_size):
+        for field_id, field in _iter_extra_fields(extra):
+            if field_id != _ZIP64_EXTRA_ID:
+                continue
+            self._is_zip64 = True
+            values = list(struct.unpack('<%dQ' % (len(field) // 8), field[:len(field) // 8 * 8]))
+            if file_size == _ZIP64_LIMIT and values:
+                values.pop(0)
+            if compress_size == _ZIP64_LIMIT and values:
+                compress_size = values.pop(0)
+        return compress_size
+
+    def read(self, size = _CHUNK_SIZE):
+        ''' Reads up to size bytes of uncompressed data '''
+        while not self._eof:
+            data = self._read_stored(size) if self._decompressor is None else self._read_deflated(size)
+            if data:
+                self._crc = zlib.crc32(data, self._crc)
+                self.size += len(data)
+                return data
+        return b''
+
+    def finish(self):
+        ''' Skips what was not read, then checks the data descriptor and CRC '''
+        while self.read(_CHUNK_SIZE):
+            pass
+
+        if self._flags & _FLAG_DATA_DESCRIPTOR:
+            descriptor = self._reader.read_exact(4)
+            if descriptor == _DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = self._reader.read_exact(4)
+            self._expected_crc = struct.unpack('<I', descriptor)[0]
+            self._reader.read_exact(16 if self._is_zip64 else 8)
+
+        if self._crc != self._expected_crc:
+            raise zipfile.BadZipFile('Bad CRC-32 for file %s' % self.name)
+
+    def _read_stored(self, size):
+        data = self._reader.read(min(size, self._remaining))
+        if not data:
+            raise zipfile.BadZipFile('Unexpected end of archive in %s' % self.name)
+        self._remaining -= len(data)
+        self._eof = self._remaining == 0
+        return data
+
+    def _read_deflated(self, size):
+        if not self._input:
+            chunk_size = _CHUNK_SIZE if self._remaining is None else min(_CHUNK_SIZE, self._remaining)
+            self._input = self._reader.read(chunk_size) if chunk_size > 0 else b''
+            if not self._input:
+                raise zipfile.BadZipFile('Unexpected end of archive in %s' % self.name)
+            if self._remaining is not None:
+                self._remaining -= len(self._input)
+
+        data = self._decompressor.decompress(self._input, size)
+        self._input = self._decompressor.unconsumed_tail
+        if self._decompressor.eof:
+            self._eof = True
+            if self._decompressor.unused_data:
+                self._reader.unread(self._decompressor.unused_data)
+        return data
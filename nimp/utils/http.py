@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2018 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' HTTP related utilities '''
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+_CHUNK_SIZE = 64 * 1024
+_SESSION = None
+
+# Connect and read timeouts, in seconds, of every request: a stalled
+# connection raises rather than blocking forever, so it can be retried
+TIMEOUT = (10, 60)
+
+def get_session():
+    ''' Returns the session shared by all HTTP transfers, so connections to
+        artifact servers are kept alive and reused '''
+    global _SESSION #pylint: disable=global-statement
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = 16)
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+def is_url(location):
+    ''' Tells whether a location is an HTTP URL rather than a path '''
+    return location.startswith('http://') or location.startswith('https://')
+
+def fetch_listing(url, cache_directory, parse, parse_key):
+    ''' Fetches a directory listing and returns parse(listing_content).
+
+        The listing and its parsed results, keyed by parse_key, are cached
+        on disk along with the ETag / Last-Modified validators of the
+        response: when the server answers a conditional request with 304,
+        neither the transfer nor the parsing happen again. '''
+    cache_path = os.path.join(cache_directory, hashlib.md5(url.encode('utf8')).hexdigest() + '.json')
+    cached_listing = _read_cache(cache_path)
+
+    headers = {}
+    if cached_listing is not None:
+        if cached_listing['etag'] is not None:
+            headers['If-None-Match'] = cached_listing['etag']
+        if cached_listing['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached_listing['last_modified']
+
+    response = get_session().get(url, headers = headers, timeout = TIMEOUT)
+    if response.status_code == 304 and cached_listing is not None:
+        logging.debug('Listing of %s is not modified, using cached version', url)
+        results = cached_listing['results']
+        if parse_key not in results:
+            results[parse_key] = parse(cached_listing['content'])
+            _write_cache(cache_path, cached_listing)
+        return results[parse_key]
+
+    response.raise_for_status()
+    result = parse(response.text)
+    listing = { 'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content': response.text,
+                'results': { parse_key: result } }
+    if listing['etag'] is not None or listing['last_modified'] is not None:
+        _write_cache(cache_path, listing)
+    return result
+
+def _read_cache(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError) as ex:
+        logging.debug('Ignoring unreadable cache %s: %s', cache_path, ex)
+        return None
+
+def _write_cache(cache_path, content):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        cache_tmp = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(cache_tmp, 'w') as cache_file:
+            json.dump(content, cache_file)
+        os.replace(cache_tmp, cache_path)
+    except OSError as ex:
+        logging.debug('Unable to write cache %s: %s', cache_path, ex)
+
+class RangeNotSupportedError(Exception):
+    ''' Raised when a server does not support HTTP range requests '''
+
+class RangeFile(io.RawIOBase):
+    ''' Seekable read-only file over HTTP, only fetching the parts that are
+        read with range requests. Fetched blocks are kept in a LRU cache, and
+        blocks following a missing one are fetched along with it so that
+        sequential reads do not cost a request per block. '''
+    def __init__(self, url, block_size = 1024 * 1024, read_ahead = 16, cache_size = 64):
+        super(RangeFile, self).__init__()
+        self.url = url
+        self._block_size = block_size
+        self._read_ahead = read_ahead
+        self._cache_size = max(cache_size, read_ahead)
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+        with contextlib.closing(get_session().get(url, headers = { 'Range': 'bytes=0-0' }, stream = True, timeout = TIMEOUT)) as response:
+            response.raise_for_status()
+            self.size = get_range_total_size(response)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), self.size - self._position))
+        copied = 0
+        while copied < size:
+            block_index = self._position // self._block_size
+            block_offset = self._position - block_index * self._block_size
+            chunk = self._get_block(block_index)[block_offset:block_offset + size - copied]
+            buffer[copied:copied + len(chunk)] = chunk
+            copied += len(chunk)
+            self._position += len(chunk)
+        return copied
+
+    def _get_block(self, block_index):
+        if block_index in self._blocks:
+            self._blocks.move_to_end(block_index)
+            return self._blocks[block_index]
+
+        block_count = (self.size + self._block_size - 1) // self._block_size
+        last_block = block_index
+        while (last_block + 1 < min(block_count, block_index + self._read_ahead)
+               and last_block + 1 not in self._blocks):
+            last_block += 1
+
+        start = block_index * self._block_size
+        end = min(self.size, (last_block + 1) * self._block_size) - 1
+        response = get_session().get(self.url, headers = { 'Range': 'bytes=%d-%d' % (start, end) }, timeout = TIMEOUT)
+        response.raise_for_status()
+        get_range_total_size(response)
+        if len(response.content) != end - start + 1:
+            raise IOError('Expected %d bytes from %s, got %d' % (end - start + 1, self.url, len(response.content)))
+
+        for index in range(block_index, last_block + 1):
+            offset = (index - block_index) * self._block_size
+            self._blocks[index] = response.content[offset:offset + self._block_size]
+        while len(self._blocks) > self._cache_size:
+            self._blocks.popitem(last = False)
+        return self._blocks[block_index]
+
+def get_range_total_size(response):
+    ''' Checks a response is a partial content one and returns the total
+        size of the requested resource '''
+    if response.status_code != 206:
+        raise RangeNotSupportedError('%s does not support range requests' % response.url)
+    total_size = response.headers.get('Content-Range', '').rpartition('/')[2]
+    if not total_size.isdigit():
+        raise RangeNotSupportedError('%s did not tell its size' % response.url)
+    return int(total_size)
+
+class DownloadError(Exception):
+    ''' Raised when a download ends before all the expected data is received '''
+
+class Download(object):
+    ''' Downloads a resource to a file. When the server supports range
+        requests, the resource is split into segments fetched concurrently
+        over pooled connections, each segment being retried on its own if the
+        transfer fails. Otherwise the resource is downloaded in a single
+        stream, restarted from the beginning on failure.
+
+        The progress of every segment is saved next to the file along with
+        the ETag / Last-Modified validator of the resource, so an
+        interrupted download is resumed by the next run as long as the
+        resource did not change. '''
+    def __init__(self, url):
+        self.url = url
+        self._segments = []
+        self._downloaded = 0
+        self._logged_percentage = 0
+        self._state_path = None
+        self._state_time = 0
+        self._lock = threading.Lock()
+        with contextlib.closing(get_session().get(url, headers = { 'Range': 'bytes=0-0' }, stream = True, timeout = TIMEOUT)) as response:
+            response.raise_for_status()
+            try:
+                self.size = get_range_total_size(response)
+                self.supports_ranges = True
+            except RangeNotSupportedError:
+                content_length = response.headers.get('Content-Length')
+                self.size = int(content_length) if content_length is not None else None
+                self.supports_ranges = False
+            self.validator = { 'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified'),
+                               'size': self.size }
+
+    @property
+    def resumable(self):
+        ''' Whether an interrupted download of this resource can be resumed '''
+        return (self.supports_ranges and self.size is not None
+                and (self.validator['etag'] is not None or self.validator['last_modified'] is not None))
+
+    @staticmethod
+    def remove(destination):
+        ''' Removes a downloaded file along with its download state '''
+        for path in [ destination, Download._get_state_path(destination) ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self, destination, segment_count = 8, min_segment_size = 16 * 1024 * 1024, retries = 3, sha256 = None):
+        ''' Downloads the resource to destination, resuming a previous
+            download of the same resource if there is one. If a SHA-256 hash
+            is given, the downloaded data is hashed as it arrives, and the
+            resource is downloaded again from scratch once if it does not
+            match. '''
+        for attempt in range(2):
+            digest = self._run(destination, segment_count, min_segment_size, retries, sha256 is not None)
+            if sha256 is None or digest == sha256.lower():
+                return
+            if attempt == 0:
+                logging.warning('%s does not match its SHA-256 hash, downloading it again', self.url)
+                Download.remove(destination)
+        raise DownloadError('%s does not match its SHA-256 hash' % self.url)
+
+    def _run(self, destination, segment_count, min_segment_size, retries, compute_hash):
+        self._state_path = Download._get_state_path(destination) if self.resumable else None
+        self._segments = self._load_segments(destination)
+        if self._segments is None:
+            self._segments = self._split(segment_count, min_segment_size)
+            with open(destination, 'wb') as output:
+                if self.size is not None:
+                    output.truncate(self.size)
+        else:
+            logging.info('Resuming download of %s', self.url)
+        self._downloaded = (self.size or 0) - sum(end + 1 - position for position, end in self._segments if end is not None)
+        self._logged_percentage = 0
+
+        try:
+            pending_segments = [ segment for segment in self._segments if segment[1] is None or segment[0] <= segment[1] ]
+            with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, len(pending_segments))) as executor:
+                results = [ executor.submit(self._fetch_segment, destination, segment, retries) for segment in pending_segments ]
+                digest = self._hash_downloaded_data(destination, results) if compute_hash else None
+                for result in results:
+                    result.result()
+                return digest
+        finally:
+            with self._lock:
+                self._save_state()
+
+    def _hash_downloaded_data(self, destination, results):
+        # Hashes data as soon as everything before it is downloaded, reading
+        # it back while it is still in the page cache
+        data_hash = hashlib.sha256()
+        hashed_size = 0
+        with open(destination, 'rb') as input_file:
+            while True:
+                if any(result.done() and result.exception() is not None for result in results):
+                    return None
+                is_done = all(result.done() for result in results)
+                available_size = self._get_downloaded_prefix_size()
+                while hashed_size < available_size:
+                    chunk = input_file.read(min(_CHUNK_SIZE * 16, available_size - hashed_size))
+                    if not chunk:
+                        break
+                    data_hash.update(chunk)
+                    hashed_size += len(chunk)
+                if is_done:
+                    return data_hash.hexdigest()
+                concurrent.futures.wait(results, timeout = 0.1, return_when = concurrent.futures.FIRST_EXCEPTION)
+
+    def _get_downloaded_prefix_size(self):
+        with self._lock:
+            prefix_size = 0
+            for position, end in self._segments:
+                if end is None or position <= end:
+                    return position
+                prefix_size = end + 1
+            return prefix_size
+
+    @staticmethod
+    def _get_state_path(destination):
+        return destination + '.download.json'
+
+    def _split(self, segment_count, min_segment_size):
+        if not self.supports_ranges or not self.size:
+            return [ [ 0, self.size - 1 if self.size is not None else None ] ]
+        segment_count = max(1, min(segment_count, self.size // min_segment_size))
+        segment_size = (self.size + segment_count - 1) // segment_count
+        return [ [ start, min(self.size, start + segment_size) - 1 ] for start in range(0, self.size, segment_size) ]
+
+    def _load_segments(self, destination):
+        if self._state_path is None or not os.path.isfile(destination):
+            return None
+        state = _read_cache(self._state_path)
+        if state is None or state['validator'] != self.validator or os.path.getsize(destination) != self.size:
+            return None
+        return state['segments']
+
+    def _save_state(self):
+        # Called with the lock held, once the segments data is flushed
+        if self._state_path is not None:
+            _write_cache(self._state_path, { 'url': self.url, 'validator': self.validator, 'segments': self._segments })
+            self._state_time = time.monotonic()
+
+    def _fetch_segment(self, destination, segment, retries):
+        start, end = segment
+        attempt = 0
+        while True:
+            try:
+                headers = { 'Range': 'bytes=%d-%d' % (segment[0], end) } if self.supports_ranges else {}
+                with contextlib.closing(get_session().get(self.url, headers = headers, stream = True, timeout = TIMEOUT)) as response:
+                    response.raise_for_status()
+                    if self.supports_ranges:
+                        get_range_total_size(response)
+                    with open(destination, 'r+b') as output:
+                        output.seek(segment[0])
+                        for chunk in response.iter_content(_CHUNK_SIZE):
+                            if end is not None:
+                                chunk = chunk[:end + 1 - segment[0]]
+                            output.write(chunk)
+                            output.flush()
+                            self._add_progress(segment, len(chunk))
+                if end is None or segment[0] > end:
+                    return
+                raise DownloadError('Connection to %s closed after %d bytes' % (self.url, segment[0] - start))
+            except (requests.RequestException, DownloadError) as ex:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logging.warning('Download of %s has failed (%s), retrying (%d/%d)', self.url, ex, attempt, retries)
+                if not self.supports_ranges:
+                    self._add_progress(segment, start - segment[0])
+
+    def _add_progress(self, segment, byte_count):
+        with self._lock:
+            segment[0] += byte_count
+            self._downloaded += byte_count
+            if time.monotonic() - self._state_time > 1:
+                self._save_state()
+            if not self.size:
+                return
+            percentage = int(self._downloaded * 100 / self.size)
+            if percentage >= self._logged_percentage + 5:
+                self._logged_percentage = percentage
+                logging.info('%d%% downloaded', percentage)
+
+class UploadError(Exception):
+    ''' Raised when data cannot be sent to an HTTP server '''
+
+def make_collections(url):
+    ''' Creates the WebDAV collections a resource is to be published in,
+        from the topmost one. Servers only supporting PUT, or which already
+        have them, just refuse to. '''
+    split_url = urllib.parse.urlsplit(url)
+    path = ''
+    for directory in split_url.path.split('/')[1:-1]:
+        path += '/' + directory
+        collection_url = urllib.parse.urlunsplit((split_url.scheme, split_url.netloc, path + '/', '', ''))
+        response = get_session().request('MKCOL', collection_url, timeout = TIMEOUT)
+        logging.debug('MKCOL %s: %d', collection_url, response.status_code)
+
+def put(url, data):
+    ''' Publishes some data with a PUT request '''
+    get_session().put(url, data = data, timeout = TIMEOUT).raise_for_status()
+
+def move(url, destination_url):
+    ''' Moves a resource to another URL with a WebDAV MOVE request,
+        replacing what is there '''
+    headers = { 'Destination': destination_url, 'Overwrite': 'T' }
+    get_session().request('MOVE', url, headers = headers, timeout = TIMEOUT).raise_for_status()
+
+def delete(url):
+    ''' Deletes a resource, servers not allowing it just refuse to '''
+    try:
+        response = get_session().delete(url, timeout = TIMEOUT)
+        logging.debug('DELETE %s: %d', url, response.status_code)
+    except requests.RequestException as ex:
+        logging.debug('DELETE %s: %s', url, ex)
+
+class UploadStream(io.RawIOBase):
+    ''' Write-only stream sent to an HTTP server with a PUT request as it is
+        written, with chunked transfer encoding, so nothing is buffered on
+        disk. Data is sent from another thread, writes only waiting for it
+        when the server is slower than data is produced. The size and SHA-256
+        hash of the data are computed along the way. Leaving the stream on
+        an exception aborts the request, so the server drops what it got. '''
+    _ABORT = object()
+
+    def __init__(self, url, queue_size = 16):
+        super(UploadStream, self).__init__()
+        self.url = url
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._error = None
+        self._thread = threading.Thread(target = self._send, daemon = True)
+        self._thread.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        self.sha256.update(data)
+        if len(self._buffer) >= _CHUNK_SIZE * 16:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        ''' Sends what is left to send and waits for the server response,
+            raising UploadError if it is an error '''
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+            self._put(None)
+            self._thread.join()
+        finally:
+            super(UploadStream, self).close()
+        if self._error is not None:
+            raise UploadError('Upload to %s has failed: %s' % (self.url, self._error))
+
+    def abort(self):
+        ''' Interrupts the request without completing it '''
+        if self.closed:
+            return
+        try:
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(UploadStream._ABORT, timeout = 1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+        finally:
+            super(UploadStream, self).close()
+
+    def _put(self, chunk):
+        while True:
+            try:
+                self._queue.put(chunk, timeout = 1)
+                return
+            except queue.Full:
+                # The request ended early, nobody is reading anymore
+                if not self._thread.is_alive():
+                    raise UploadError('Upload to %s has failed: %s' % (self.url, self._error))
+
+    def _iter_chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if chunk is UploadStream._ABORT:
+                raise UploadError('Upload to %s was aborted' % self.url)
+            yield chunk
+
+    def _send(self):
+        try:
+            # Data given as a generator is sent with chunked transfer encoding
+            put(self.url, self._iter_chunks())
+        except Exception as ex: #pylint: disable=broad-except
+            self._error = ex
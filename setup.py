@@ -35,7 +35,6 @@ setup_info = dict(
 
     install_requires = [
         'glob2',
-        'python-magic',
         'requests',
     ],
 